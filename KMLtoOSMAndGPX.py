@@ -23,13 +23,75 @@
 #	data to more closely match GPSVisualizer output.  Down to the <trkseg><extensions> section.  The
 #	presence of this section prevents the GPX file from being loaded directly into basecamp.
 #	Updated code to put osmand: on <extensions> tags which is what OSMAnd does.
+#10/16/2026: V2.5 Large KML files used too much memory since the whole file was parsed with
+#	ET.parse before any conversion was done.  The KML file is now streamed with iterparse and each
+#	placemark is converted and thrown away as soon as it has been read.  Placemarks are now
+#	converted once, for their innermost folder, instead of once for every enclosing folder.
+#	Each placemark's subtree is walked once to find its name, description, styleUrl and
+#	coordinates.  Added -o option to write tracks in KML document order.  Added -f option to
+#	either keep nested folders as their own layers or flatten them into their top level layer.
+#	lxml, with precompiled XPath lookups, is used to read the KML file when it is installed.
+#	Added -b option to pick the parser backend.  KMZ files are read directly, without
+#	unzipping them first.  Track coordinates are parsed with numpy when it is installed and
+#	kept in arrays, instead of an element per trackpoint, until the GPX file is written.
+#	The GPX file is written directly instead of being pretty printed by minidom.  Added -i
+#	option to write each waypoint and track as soon as it has been converted.  The icon
+#	table is built once instead of on every waypoint.  Added --batch option to convert
+#	directories of KML files in parallel.  KML files that haven't changed since they were
+#	last converted are skipped, unless the --no-cache option is specified.  With the -l flag
+#	finished layers are written on background threads while the next layers are converted.
+#	Added --timings option to show where the conversion time goes, and --memory-report to
+#	show how much memory it needs.  Waypoint and track names are only displayed with the new
+#	-v option, a progress line is displayed instead.  Added -q option to display nothing but
+#	warnings and errors.  Added the convert() function to use the converter from python.  The
+#	counts are no longer globals so it can convert any number of files in one process.
+#	kml_file and gpx_file can be "-" to read the KML file from stdin and write the GPX file
+#	to stdout, the messages then go to stderr.  Added -z and --compress-level options to
+#	write gzip or zip compressed GPX files, compressed as they are written.  Added --simplify
+#	option to drop trackpoints a track's shape doesn't need, and --max-track-points and
+#	--max-points options to limit the number of trackpoints.  Added --dedupe and
+#	--dedupe-distance options to drop repeated trackpoints.  Added --precision and
+#	--drop-zero-ele options to make the GPX files smaller.  The total length of the tracks
+#	is displayed.  Added --track-stats option to write each track's length and trackpoint
+#	count in the GPX file, and --stats-json to write them to a JSON file.
 #========================================================================================
 import argparse
+import array
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import math
+import os
+import time
+import types
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from xml.sax.saxutils import escape
 import ntpath
+import sys
+import threading
+import tracemalloc
+import zipfile
+try:
+	import resource
+except ImportError:
+	# not available on windows, the peak RSS isn't reported
+	resource = None
+try:
+	from lxml import etree as lxmlET
+except ImportError:
+	lxmlET = None	# lxml is optional, the stdlib parser is used when it is not installed
+try:
+	import numpy
+except ImportError:
+	numpy = None	# numpy is optional, track coordinates are parsed a point at a time without it
 
-PROGRAM_VERSION = "2.4"
+PROGRAM_VERSION = "2.5"
 DEFAULT_TRACK_TRANSPARENCY = "80"
 DEFAULT_TRACK_WIDTH = "14"
 # Both of these should probably be command line arguments
@@ -44,12 +106,58 @@ KMLCOLOR = "KMLCOLOR"
 LAYERS_TO_IGNORE = ["Untitled layer"]
 # list of fields to insert into the GPX element
 
-# globals to keep track of some counts
-countFolders = 0
-countFolderWaypoints = 0
-countFolderTracks = 0
-countTotalWaypoints = 0
-countTotalTracks = 0
+# KML tags looked up by the streaming reader
+KML_NAMESPACE = "{http://www.opengis.net/kml/2.2}"
+KML_DOCUMENT = KML_NAMESPACE + "Document"
+KML_FOLDER = KML_NAMESPACE + "Folder"
+KML_PLACEMARK = KML_NAMESPACE + "Placemark"
+KML_NAME = KML_NAMESPACE + "name"
+KML_DESCRIPTION = KML_NAMESPACE + "description"
+KML_STYLEURL = KML_NAMESPACE + "styleUrl"
+KML_POINT = KML_NAMESPACE + "Point"
+KML_LINESTRING = KML_NAMESPACE + "LineString"
+KML_COORDINATES = KML_NAMESPACE + "coordinates"
+# events returned by iterKMLPlacemarks()
+EVENT_PLACEMARK = "placemark"
+EVENT_FOLDER_END = "folder_end"
+# --order choices: where each layer's tracks are written relative to its waypoints
+ORDER_WAYPOINTS_FIRST = "waypoints"
+ORDER_DOCUMENT = "document"
+# --backend choices: which XML parser reads the KML file
+BACKEND_AUTO = "auto"
+BACKEND_LXML = "lxml"
+BACKEND_STDLIB = "stdlib"
+# --folders choices: how nested KML folders are turned into layers
+FOLDERS_PRESERVE = "preserve"
+FOLDERS_FLATTEN = "flatten"
+
+# kml_file or gpx_file "-" reads the KML file from stdin or writes the GPX file to stdout
+STDIO_FILENAME = "-"
+# the first bytes of a zip, i.e. KMZ, file
+ZIP_SIGNATURE = b"PK\x03\x04"
+# --compress choices: how GPX files are compressed, auto picks by the gpx_file extension
+COMPRESS_AUTO = "auto"
+COMPRESS_NONE = "none"
+COMPRESS_GZIP = "gzip"
+COMPRESS_ZIP = "zip"
+# added to the .gpx of layer and batch file names
+COMPRESS_EXTENSIONS = {COMPRESS_NONE: "", COMPRESS_GZIP: ".gz", COMPRESS_ZIP: ".zip"}
+DEFAULT_COMPRESS_LEVEL = 6
+# mean earth radius, for distances between trackpoints
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_MILE = 1609.344
+# message levels, see cLog
+LOG_WARNING = 0
+LOG_INFO = 1
+LOG_DEBUG = 2
+# The conversion cache remembers this many conversions, the least recently used are dropped
+MAX_CACHE_ENTRIES = 1000
+CACHE_INDEX_FILE = "cache.json"
+# names used for layers without a KML folder in the per layer timings
+ROOT_LAYER_NAME = "(outside of any layer)"
+IGNORED_LAYER_NAME = "(ignored layers)"
+# With the -l flag, at most this many converted layers wait for or are being written at once
+MAX_PENDING_LAYER_WRITES = 4
 #========================================================================================
 #There are certain characters that can't be in HTML/XML name or description strings. 
 #This function converts them to the HTML escaped version
@@ -68,21 +176,426 @@ def html_escape(text):
 #========================================================================================
 #========================================================================================
 class cWaypoint:
+	__slots__ = ("icon","color","background")
 	def __init__ (self,icon,color,background):
 		self.icon = icon
 		self.color = color
 		self.background = background
 #========================================================================================
+# cPlacemark
+# Everything the conversion needs from one KML <Placemark>, gathered by classifyPlacemark.
+# Each field holds the text of the first matching tag, or None if the tag is missing.
 #========================================================================================
-def setupParseCmdLine():
+class cPlacemark:
+	def __init__ (self):
+		self.name = None
+		self.description = None
+		self.styleUrl = None
+		self.point = None			# <Point><coordinates> text, placemark is a waypoint
+		self.linestring = None		# <LineString><coordinates> text, placemark is a track
+#========================================================================================
+# cTrack
+# A GPX <trk> element whose trackpoints are kept in three arrays of doubles (numpy arrays,
+# or array module arrays without numpy) instead of a <trkpt> and <ele> element per point.
+# That is 24 bytes per trackpoint.  cGPXWriter writes the trackpoints from the arrays.
+#========================================================================================
+class cTrack(ET.Element):
+	def __init__ (self,lon,lat,ele,countRead=None,countDuplicates=0):
+		super().__init__("trk")
+		self.lon = lon
+		self.lat = lat
+		self.ele = ele
+		# trackpoints in the KML file, before any were simplified away
+		self.countRead = len(lat) if countRead is None else countRead
+		# trackpoints dropped by the --dedupe option
+		self.countDuplicates = countDuplicates
+		# length in meters, see setTrackStats
+		self.length = 0.0
+		self.statsElements = None
+		# the track's --stats-json entry
+		self.stats = None
+		# each point's effective area, see visvalingamAreas, with the --max-points option
+		self.areas = None
+	def countPoints(self):
+		return(len(self.lat))
+#========================================================================================
+# cLog
+# printLog displays a message if the -q and -v options allow messages of this level.
+#	LOG_WARNING	always displayed
+#	LOG_INFO	displayed unless -q is specified
+#	LOG_DEBUG	only displayed when -v is specified, e.g. a line for every placemark
+# A progress line being displayed, see cProgress, is removed first.  Messages go to stdout,
+# or to file, e.g. stderr when the GPX file is being written to stdout.
+#========================================================================================
+class cLog:
+	def __init__ (self,level,file=None):
+		self.level = level
+		self.file = file or sys.stdout
+		self.progress = None
+	def printLog(self,level,*values):
+		if level > self.level:
+			return
+		if self.progress is not None:
+			self.progress.clear()
+		print(*values,file=self.file)
+#========================================================================================
+# cConversion
+# Everything about one conversion of a KML file: the options, counts, GPX files written,
+# progress and timings.  It is passed down to whatever needs it, instead of being kept in
+# globals, so several conversions can run in one process, one after the other or at the
+# same time on different threads.
+#========================================================================================
+class cConversion(cLog):
+	def __init__ (self,args):
+		# when the GPX file goes to stdout the messages must not get mixed into it
+		cLog.__init__(self,args.log_level,sys.stderr if args.gpx_file == STDIO_FILENAME else None)
+		self.args = args
+		self.countFolders = 0
+		self.countTotalWaypoints = 0
+		self.countTotalTracks = 0
+		self.countTotalTrackpoints = 0
+		self.countTotalTrackpointsRead = 0
+		self.countTotalDuplicates = 0
+		self.totalDistance = 0.0	# meters
+		# each track's --stats-json entry.  --batch workers collect them for the batch's
+		# --stats-json file rather than writing their own
+		self.collectStats = args.stats_json is not None or getattr(args,"returnStats",False)
+		self.trackStats = []
+		# GPX files written, recorded in the conversion cache
+		self.outputFiles = []
+		# the -i flag's cGPXStreams
+		self.streams = []
+		self.progress = cProgress(self.level >= LOG_INFO,self.file)
+		if args.memory_report:
+			self.timings = cTimings(args.timings or args.timings_json is not None,cMemoryReport())
+		else:
+			self.timings = cTimings(args.timings or args.timings_json is not None)
+	def abortStreams(self):
+		# the conversion failed, remove the GPX files it was part way through writing
+		for stream in self.streams:
+			stream.abort()
+	def removeTrackpoints(self,count,distance):
+		# trackpoints dropped after their layer was finished, by the --max-points option
+		self.countTotalTrackpoints -= count
+		self.totalDistance -= distance
+	def stats(self):
+		# the file's --stats-json entry
+		return({
+			"kml_file":		self.args.kml_file,
+			"gpx_file":		self.args.gpx_file,
+			"waypoints":	self.countTotalWaypoints,
+			"tracks":		self.countTotalTracks,
+			"trackpoints":	self.countTotalTrackpoints,
+			"folders":		self.countFolders,
+			"distance_m":	round(self.totalDistance,1),
+			"track_list":	self.trackStats,
+		})
+	def result(self):
+		return(cConversionResult(self.countTotalWaypoints,self.countTotalTracks,self.countTotalTrackpoints,self.countFolders,list(self.outputFiles),self.totalDistance,
+			self.stats() if self.collectStats else None))
+#========================================================================================
+# cConversionResult
+# What convert() returns.  distance is the total length of the tracks in meters.  folders
+# and distance are None when the conversion was skipped because the conversion cache
+# showed the GPX files were up to date.  stats is the file's --stats-json entry, None
+# without the --stats-json option.
+#========================================================================================
+class cConversionResult:
+	def __init__ (self,waypoints,tracks,trackpoints,folders,outputFiles,distance=None,stats=None):
+		self.waypoints = waypoints
+		self.tracks = tracks
+		self.trackpoints = trackpoints
+		self.folders = folders
+		self.outputFiles = outputFiles
+		self.distance = distance
+		self.stats = stats
+#========================================================================================
+# cProgress
+# Displays how far the conversion has got: how much of the KML file has been read and how
+# many placemarks have been converted.  So it doesn't slow the conversion down or flood
+# the output it is displayed at most every PROGRESS_INTERVAL seconds, rewriting the same
+# line on a console, or every PROGRESS_LOG_INTERVAL seconds, a line each time, when the
+# output is going to a file.  It isn't displayed with the -q option.
+#========================================================================================
+PROGRESS_INTERVAL = 0.25
+PROGRESS_LOG_INTERVAL = 5.0
+class cProgress:
+	def __init__ (self,enabled,file):
+		self.enabled = enabled
+		self.file = file
+		self.console = enabled and file.isatty()
+		self.interval = PROGRESS_INTERVAL if self.console else PROGRESS_LOG_INTERVAL
+		self.next = time.monotonic() + self.interval
+		self.showing = False	# a progress line is on the console and not ended yet
+		self.source = None
+		self.size = None
+		self.placemarks = 0
+		self.waypoints = 0
+		self.tracks = 0
+		self.trackpoints = 0
+	def start(self,source,size):
+		# source is the KML file being read, size is its length or None if not known
+		self.source = source
+		self.size = size
+	def update(self):
+		self.placemarks += 1
+		if not self.enabled or time.monotonic() < self.next:
+			return
+		self.next = time.monotonic() + self.interval
+		self.display()
+	def display(self):
+		line = "  Progress: placemarks: %d waypoints: %d tracks: %d trackpoints: %d" % (self.placemarks, self.waypoints, self.tracks, self.trackpoints)
+		if self.size and self.source is not None and not self.source.closed:
+			line += "  (%d%% of input)" % min(100, 100 * self.source.tell() // self.size)
+		if self.console:
+			self.file.write("\r" + line + "\x1b[K")
+			self.file.flush()
+			self.showing = True
+		else:
+			print(line,file=self.file)
+			self.file.flush()
+	def clear(self):
+		# remove the progress line so a message can be displayed in its place
+		if self.showing:
+			self.file.write("\r\x1b[K")
+			self.showing = False
+#========================================================================================
+# cTimings
+# Records the wall clock and CPU time of each phase of a conversion, in total and for each
+# layer, when the --timings option is specified.  A phase is timed with:
+#		with timings.phase("tracks",layer.name):
+# Phases can be nested, e.g. writing a track with the -i flag happens inside "tracks".
+# The time of a nested phase is only counted for the nested phase.  CPU time is per
+# thread, so the layers written by cLayerWriter threads are timed correctly.
+# With the --memory-report option the phases are also measured by a cMemoryReport.
+# When neither is wanted phase() returns a context manager that does nothing.
+#========================================================================================
+TIMINGS_PHASES = ["parse","classify","waypoints","tracks","extensions","write"]
+class cTimings:
+	def __init__ (self,enabled,memory=None):
+		self.enabled = enabled or memory is not None
+		self.memory = memory
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.phases = {}	# phase: [wall seconds, CPU seconds]
+		self.layers = {}	# layer name: {phase: [wall seconds, CPU seconds]}
+		# the total CPU time includes the cLayerWriter threads
+		self.start = (time.perf_counter(), time.process_time())
+		self.total = [0.0, 0.0]
+	def phase(self,name,layer=None):
+		if not self.enabled:
+			return(NO_TIMING)
+		return(cTimedPhase(self,name,layer))
+	def iterate(self,name,iterable):
+		# times getting each item from iterable, but not the caller's use of the item
+		iterator = iter(iterable)
+		while True:
+			with self.phase(name):
+				try:
+					item = next(iterator)
+				except StopIteration:
+					return
+			yield item
+	def add(self,name,layer,wall,cpu):
+		with self.lock:
+			totals = self.phases.setdefault(name,[0.0, 0.0])
+			totals[0] += wall
+			totals[1] += cpu
+			if layer is not None:
+				totals = self.layers.setdefault(layer,{}).setdefault(name,[0.0, 0.0])
+				totals[0] += wall
+				totals[1] += cpu
+	def finish(self):
+		self.total = [time.perf_counter() - self.start[0], time.process_time() - self.start[1]]
+	def display(self,file):
+		print("",file=file)
+		print("   Timings (seconds)              wall        cpu",file=file)
+		for name in self.orderedPhases(self.phases):
+			print("      %-24s %10.3f %10.3f" % (name, self.phases[name][0], self.phases[name][1]),file=file)
+		print("      %-24s %10.3f %10.3f" % ("total", self.total[0], self.total[1]),file=file)
+		for layer, phases in self.layers.items():
+			print("   Layer:", layer,file=file)
+			for name in self.orderedPhases(phases):
+				print("      %-24s %10.3f %10.3f" % (name, phases[name][0], phases[name][1]),file=file)
+	def orderedPhases(self,phases):
+		return([name for name in TIMINGS_PHASES if name in phases] + [name for name in phases if name not in TIMINGS_PHASES])
+	def toDict(self):
+		def seconds(phases):
+			return({name: {"wall": phases[name][0], "cpu": phases[name][1]} for name in self.orderedPhases(phases)})
+		return({
+			"total":	{"wall": self.total[0], "cpu": self.total[1]},
+			"phases":	seconds(self.phases),
+			"layers":	{layer: seconds(phases) for layer, phases in self.layers.items()},
+		})
+	def writeJSON(self,filename,counts):
+		with open(filename,"w",encoding="utf-8") as f:
+			json.dump(dict(counts, timings=self.toDict()),f,indent=2)
+#========================================================================================
+# cTimedPhase
+# Context manager returned by cTimings.phase().
+#========================================================================================
+NO_TIMING = contextlib.nullcontext()
+class cTimedPhase:
+	__slots__ = ("timings","name","layer","start","nested","memory")
+	def __init__ (self,timings,name,layer):
+		self.timings = timings
+		self.name = name
+		self.layer = layer
+	def __enter__ (self):
+		stack = self.timings.local.__dict__.setdefault("stack",[])
+		if self.timings.memory is not None:
+			self.timings.memory.enter(self,stack[-1] if stack else None)
+		stack.append(self)
+		self.nested = [0.0, 0.0]
+		self.start = (time.perf_counter(), time.thread_time())
+	def __exit__ (self,*exception):
+		wall = time.perf_counter() - self.start[0]
+		cpu = time.thread_time() - self.start[1]
+		stack = self.timings.local.stack
+		stack.pop()
+		if self.timings.memory is not None:
+			self.timings.memory.exit(self,stack[-1] if stack else None)
+		if stack:
+			stack[-1].nested[0] += wall
+			stack[-1].nested[1] += cpu
+		self.timings.add(self.name,self.layer,wall - self.nested[0],cpu - self.nested[1])
+		return(False)
+#========================================================================================
+# cMemoryReport
+# With the --memory-report option the python memory allocations are traced with
+# tracemalloc while the file is converted.  For each phase timed by cTimings it records the
+# peak traced memory while the phase ran, and the memory retained by the phase, i.e. still
+# allocated when it finished.  The retained memory of the waypoints and tracks phases gives
+# the bytes needed for each waypoint and trackpoint, which together with the peak RSS is
+# what's needed to work out how big a KML file a memory limited worker can convert.
+# tracemalloc has only one peak, so the layers are written on the main thread while memory
+# is being reported, and only one conversion at a time in a process should report memory.
+#========================================================================================
+class cMemoryReport:
+	def __init__ (self):
+		self.peaks = {}		# phase: peak traced bytes
+		self.retained = {}	# phase: bytes allocated and not freed by the phase
+		self.peak = 0
+		self.peakRSS = None
+		tracemalloc.start()
+	def enter(self,phase,parent):
+		current, peak = tracemalloc.get_traced_memory()
+		self.peak = max(self.peak, peak)
+		if parent is not None:
+			parent.memory[1] = max(parent.memory[1], peak)
+		tracemalloc.reset_peak()
+		phase.memory = [current, current]	# traced bytes at the start, peak
+	def exit(self,phase,parent):
+		current, peak = tracemalloc.get_traced_memory()
+		self.peak = max(self.peak, peak)
+		peak = max(phase.memory[1], peak)
+		if parent is not None:
+			parent.memory[1] = max(parent.memory[1], peak)
+		self.peaks[phase.name] = max(self.peaks.get(phase.name,0), peak)
+		self.retained[phase.name] = self.retained.get(phase.name,0) + current - phase.memory[0]
+	def finish(self):
+		self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+		tracemalloc.stop()
+		if resource is not None:
+			self.peakRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			if sys.platform != "darwin":
+				# linux reports kilobytes, macOS bytes
+				self.peakRSS *= 1024
+	def perItem(self,phase,count):
+		if count == 0:
+			return(None)
+		return(self.retained.get(phase,0) // count)
+	def display(self,file,waypoints,trackpoints):
+		print("",file=file)
+		print("   Memory (bytes)                   peak      retained",file=file)
+		for name in [name for name in TIMINGS_PHASES if name in self.peaks]:
+			print("      %-20s %13s %13s" % (name, "{:,}".format(self.peaks[name]), "{:,}".format(self.retained[name])),file=file)
+		print("   Peak traced memory:  ", "{:,}".format(self.peak),file=file)
+		if self.peakRSS is None:
+			print("   Peak RSS:             not available on this platform",file=file)
+		else:
+			print("   Peak RSS:            ", "{:,}".format(self.peakRSS),file=file)
+		for label, phase, count in (("trackpoint","tracks",trackpoints),("waypoint","waypoints",waypoints)):
+			size = self.perItem(phase,count)
+			if size is not None:
+				print("   Bytes per %-11s" % (label + ":"), "{:,}".format(size),file=file)
+	def toDict(self,waypoints,trackpoints):
+		return({
+			"peak_traced_bytes":	self.peak,
+			"peak_rss_bytes":		self.peakRSS,
+			"bytes_per_trackpoint":	self.perItem("tracks",trackpoints),
+			"bytes_per_waypoint":	self.perItem("waypoints",waypoints),
+			"phases":				{name: {"peak": self.peaks[name], "retained": self.retained[name]} for name in self.peaks},
+		})
+#========================================================================================
+# cKMLFolder
+# A KML <Folder> (google my maps layer) seen by the streaming reader.  The name is filled
+# in once the folder's own <name> tag has been read.
+#========================================================================================
+class cKMLFolder:
+	def __init__ (self,parent):
+		self.parent = parent
+		self.name = ""
+	def path(self,separator):
+		# folder names from the top level folder down to this one
+		if self.parent is None:
+			return(self.name)
+		return(self.parent.path(separator) + separator + self.name)
+#========================================================================================
+# cFolderIndex
+# Index of the KML folder tree, built up by iterKMLPlacemarks as folders are read.
+# Every placemark is owned by exactly one folder, so it is converted exactly once no matter
+# how deeply it is nested:
+#	FOLDERS_PRESERVE: the innermost folder owns it and each folder is its own layer.
+#	FOLDERS_FLATTEN: the top level folder owns it and nested folders are merged into
+#		their top level layer.
+#========================================================================================
+class cFolderIndex:
+	def __init__ (self,mode):
+		self.mode = mode
+	def addFolder(self,parent):
+		return(cKMLFolder(parent))
+	def owner(self,folder):
+		if folder is None or self.mode == FOLDERS_PRESERVE:
+			return(folder)
+		while folder.parent is not None:
+			folder = folder.parent
+		return(folder)
+	def layerName(self,folder):
+		return(self.owner(folder).path(" / "))
+	def fileSuffix(self,folder):
+		return(self.owner(folder).path("-"))
+#========================================================================================
+# cLayer
+# Output state for one folder/layer while the KML file is streamed.  Tracks are held in
+# their own element until the folder ends so they are written after the layer's waypoints,
+# the same order the file has always been written in.
+#========================================================================================
+class cLayer:
+	def __init__ (self,gpx,name):
+		self.gpx = gpx
+		self.name = name
+		self.tracks = ET.Element("gpx")
+		self.countWaypoints = 0
+		self.countTracks = 0
+		self.countTrackpoints = 0
+		self.countTrackpointsRead = 0
+		self.countDuplicates = 0
+		self.distance = 0.0
+		# the --stats-json entries of the layer's tracks
+		self.trackStats = []
+#========================================================================================
+#========================================================================================
+def setupCmdLineParser():
 	parser = argparse.ArgumentParser(
 	prog="KMLtoOSMAndGPX",
 	description="Convert google my maps KML files to OSMAnd style GPX files, including icon conversion.",
 	epilog="text at bottom of help")
 	parser.add_argument("kml_file",
-		help="the input KML file path/name")
+		nargs="+",
+		help="the input KML or KMZ file path/name, or - to read it from stdin.  With the --batch option, one or more input directories or file name patterns such as exports/*.kml")
 	parser.add_argument("gpx_file", 
-		help="the output GPX file path/name or if the -l option is specifed this is the path and output file(s) name prefix")
+		help="the output GPX file path/name, or - to write it to stdout, or if the -l option is specifed this is the path and output file(s) name prefix.  With the --batch option, the output directory")
 	parser.add_argument('-l', '--layers', 
 		action='store_true', 
 		default=False,
@@ -100,7 +613,174 @@ def setupParseCmdLine():
 		default=DEFAULT_TRACK_WIDTH,
 		type=int,
 		help='Width value to use for all tracks. Integer value between 1-24')
-	return(parser.parse_args())
+	parser.add_argument('--dedupe',
+		action='store_true',
+		default=False,
+		help='Drop trackpoints that repeat the trackpoint before them.')
+	parser.add_argument('--dedupe-distance',
+		action='store',
+		default=None,
+		type=float,
+		metavar='METERS',
+		help='With --dedupe, also drop trackpoints closer than METERS to the trackpoint before them.')
+	parser.add_argument('--simplify',
+		action='store',
+		default=None,
+		type=float,
+		metavar='TOLERANCE_M',
+		help='Simplify tracks, dropping trackpoints that are within this many meters of the line through the trackpoints that are kept.')
+	parser.add_argument('--max-track-points',
+		action='store',
+		default=None,
+		type=int,
+		metavar='N',
+		help='Reduce each track to at most N trackpoints, keeping the points that matter most to its shape.')
+	parser.add_argument('--max-points',
+		action='store',
+		default=None,
+		type=int,
+		metavar='N',
+		help='Reduce the tracks in each GPX file to N trackpoints between them, keeping the points that matter most to their shapes.  More detailed tracks keep more of their points.  Can\'t be used with -i.')
+	parser.add_argument('--precision',
+		action='store',
+		default=None,
+		type=int,
+		choices=range(0,16),
+		metavar='0-15',
+		help='Round trackpoint latitudes and longitudes to this many decimal places.  6 is about 10cm.  By default they are written in full, as the shortest text that reads back as the same value, e.g. 38.8170200 is written as 38.81702.')
+	parser.add_argument('--drop-zero-ele',
+		action='store_true',
+		default=False,
+		help='Leave out the <ele> of every trackpoint in tracks whose altitudes are all 0, as they are in google my maps exports.')
+	parser.add_argument('--track-stats',
+		action='store_true',
+		default=False,
+		help='Write each track\'s length in meters and number of trackpoints in its extensions, as <osmand:track_length> and <osmand:point_count>.')
+	parser.add_argument('--stats-json',
+		action='store',
+		default=None,
+		help='Write the counts, the total track distance and the layer, name, trackpoint count and length of each track to this JSON file.  With --batch the file has the batch totals and an entry for each file converted.')
+	parser.add_argument('-o', '--order',
+		action='store',
+		default=ORDER_WAYPOINTS_FIRST,
+		choices=[ORDER_WAYPOINTS_FIRST,ORDER_DOCUMENT],
+		help='waypoints (default): Each layer\'s waypoints are written before its tracks.  document: Waypoints and tracks are written in the order they appear in the KML file.')
+	parser.add_argument('-f', '--folders',
+		action='store',
+		default=FOLDERS_PRESERVE,
+		choices=[FOLDERS_PRESERVE,FOLDERS_FLATTEN],
+		help='preserve (default): Each KML folder, including nested folders, is its own layer.  flatten: Nested folders are merged into their top level folder\'s layer.')
+	parser.add_argument('-b', '--backend',
+		action='store',
+		default=BACKEND_AUTO,
+		choices=[BACKEND_AUTO,BACKEND_LXML,BACKEND_STDLIB],
+		help='auto (default): Use lxml to read the KML file if it is installed, else the python standard library.  lxml or stdlib: Use that parser.')
+	parser.add_argument('-i', '--incremental',
+		action='store_true',
+		default=False,
+		help='False (default): GPX files are written once all their data has been converted.  True: Each waypoint and track is written to the GPX file as soon as it is converted, in KML document order.')
+	parser.add_argument('-z', '--compress',
+		action='store',
+		default=COMPRESS_AUTO,
+		choices=[COMPRESS_AUTO,COMPRESS_NONE,COMPRESS_GZIP,COMPRESS_ZIP],
+		help='auto (default): gzip the GPX file if gpx_file ends in .gz, zip it if it ends in .zip.  none, gzip or zip: Compress the GPX files that way.  With -l and --batch the files are named .gpx.gz or .gpx.zip.')
+	parser.add_argument('--compress-level',
+		action='store',
+		default=DEFAULT_COMPRESS_LEVEL,
+		type=int,
+		choices=range(0,10),
+		metavar="0-9",
+		help='Compression level, 0 (none, fastest) to 9 (smallest, slowest).  Default: ' + str(DEFAULT_COMPRESS_LEVEL))
+	parser.add_argument('--write-threads',
+		action='store',
+		default=2,
+		type=int,
+		help='With the -l flag, number of threads writing finished layers to their GPX files while the following layers are converted.  0 writes each layer before moving on.')
+	parser.add_argument('-q', '--quiet',
+		action='store_const',
+		dest='log_level',
+		const=LOG_WARNING,
+		default=LOG_INFO,
+		help='Only display warnings and errors, no progress or counts.')
+	parser.add_argument('-v', '--verbose',
+		action='store_const',
+		dest='log_level',
+		const=LOG_DEBUG,
+		help='Also display the name of every waypoint and track as it is converted.')
+	parser.add_argument('--timings',
+		action='store_true',
+		default=False,
+		help='Display the wall clock and CPU time taken by each phase of the conversion, in total and for each layer.')
+	parser.add_argument('--timings-json',
+		action='store',
+		default=None,
+		help='Also write the timings, with the waypoint, track and folder counts, to this JSON file.')
+	parser.add_argument('--memory-report',
+		action='store_true',
+		default=False,
+		help='Trace memory use while converting and display the peak memory of each phase, the peak RSS and the bytes used per trackpoint and waypoint.')
+	parser.add_argument('--batch',
+		action='store_true',
+		default=False,
+		help='Convert every KML/KMZ file in the input directories or matching the input patterns into the output directory, several files at a time.')
+	parser.add_argument('-j', '--jobs',
+		action='store',
+		default=os.cpu_count(),
+		type=int,
+		help='Number of files converted at the same time with the --batch option.  Defaults to the number of CPUs.')
+	parser.add_argument('--no-cache',
+		action='store_true',
+		default=False,
+		help='Always convert.  By default a KML file is not converted again if it and the options are unchanged since the last time it was converted and the GPX files it produced are still there.')
+	parser.add_argument('--cache-dir',
+		action='store',
+		default=os.path.join(os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"),".cache"),"KMLtoOSMAndGPX"),
+		help='Directory the conversion cache is kept in.')
+	return(parser)
+#========================================================================================
+#========================================================================================
+def setupParseCmdLine():
+	parser = setupCmdLineParser()
+	args = parser.parse_args()
+	if args.jobs < 1:
+		parser.error("-j/--jobs must be at least 1")
+	if not args.batch:
+		if len(args.kml_file) > 1:
+			parser.error("only one kml_file can be given without the --batch option")
+		args.kml_file = args.kml_file[0]
+	try:
+		checkOptions(args)
+	except ValueError as error:
+		parser.error(str(error))
+	return(args)
+#========================================================================================
+# checkOptions
+# Raises ValueError for options that can't be used together.
+#========================================================================================
+def checkOptions(args):
+	if args.batch and (args.timings or args.timings_json or args.memory_report):
+		# the batch workers' output is thrown away and they would all write the one JSON file
+		raise ValueError("--timings, --timings-json and --memory-report report on a single conversion, they can't be used with --batch")
+	if not args.batch and args.gpx_file == STDIO_FILENAME and args.layers:
+		raise ValueError("the -l option writes several GPX files, they can't all be written to stdout")
+	if args.max_points and args.incremental:
+		raise ValueError("--max-points needs all of a GPX file's tracks before they are written, it can't be used with -i")
+	if args.dedupe_distance is not None and not args.dedupe:
+		raise ValueError("--dedupe-distance is only used with --dedupe")
+	if args.dedupe_distance is not None and args.dedupe_distance < 0:
+		raise ValueError("--dedupe-distance can't be negative")
+	if args.simplify is not None and args.simplify < 0:
+		raise ValueError("--simplify can't be negative")
+	if args.max_track_points is not None and args.max_track_points < 2:
+		raise ValueError("--max-track-points must be at least 2, the ends of a track are always kept")
+	if args.write_threads < 0:
+		raise ValueError("--write-threads can't be negative")
+#========================================================================================
+# reducesTrackpoints
+# True if the options can drop some of the trackpoints read from the KML file.
+#========================================================================================
+def reducesTrackpoints(args):
+	return(bool(args.dedupe or args.simplify or args.max_track_points or args.max_points))
 #========================================================================================
 # iconDictionary describes the mapping between a KML icon number and an OSMAnd icon name.
 # It also contains a default OSMAnd color and shape to use for each OSMAnd icon type.
@@ -152,105 +832,118 @@ def setupParseCmdLine():
 #
 # ???: would be nice to have a command line option to read in a user supplied dictionary from a file
 #========================================================================================
+iconDictionary = {
+	"unknown":["special_symbol_question_mark","e044bb","octagon"],			#unknown KML icon code - this entry will be used if the KML icon is not found the iconDictionary.
+	"1765":["tourism_camp_site",KMLCOLOR,"circle"],							#campsite
+	"1525":["leisure_marina","a71de1","octagon"],							#river access
+	"1739":["special_number_0",KMLCOLOR,"circle"],							#Mileage marker plus-KML dot on gmaps & Plus in OSMAnd. Did have this color:"1010a0"
+	"1596":["special_trekking",KMLCOLOR,"circle"],							#hiking trailhead  Color I use is 9E963A
+	"1369":["special_trekking",KMLCOLOR,"circle"],							#hiking trailhead -old style icon
+	"1371":["special_trekking",KMLCOLOR,"circle"],							#hiking trailhead -old style icon
+	"1723":["tourism_viewpoint",KMLCOLOR,"octagon"],						#rapid  "d90000"
+	"1602":["tourism_hotel",KMLCOLOR,"circle"],								#hotel, lodge
+	"1528":["bridge_structure_suspension","10c0f0","circle"],				#bridge
+	"1577":["restaurants",KMLCOLOR,"circle"],								#retaurant, diner, dining
+	"1085":["restaurants",KMLCOLOR,"circle"],								#retaurant, diner, dining, old style icon
+	"1650":["tourism_picnic_site","eecc22","circle"],						#picnic site
+	"1644":["amenity_parking",KMLCOLOR,"circle"],							#parking area
+	"1578":["shop_supermarket",KMLCOLOR,"circle"],							#grocery store, supermarket #1 - light blue "10c0f0"
+	"1685":["shop_supermarket",KMLCOLOR,"circle"],							#grocery store, supermarket #2 - light blue	"10c0f0"
+	"1023":["shop_supermarket",KMLCOLOR,"circle"],							#grocery store, supermarket #2 - light blue	"10c0f0", old style grocery icon
+	"1504":["air_transport","10c0f0","circle"],								#airport, airstrip
+	"1581":["fuel",KMLCOLOR,"circle"],										#gas station
+	"1733":["amenity_toilets","10c0f0","circle"],							#toilet, restroom
+	"1624":["amenity_doctors","d00d0d","circle"],							#hospital, doctor, emergency room
+	"1608":["tourism_information","1010a0","circle"],						#tourism information
+	"1203":["tourism_information","1010a0","circle"],						#tourism information, old style icon - big "i"
+	"1535":["special_photo_camera",KMLCOLOR,"circle"],						#POI #1, camera "eecc22"
+	"993": ["special_photo_camera",KMLCOLOR,"circle"],						#POI #1, camera "eecc22" old icon style
+	"1574":["special_flag_start",KMLCOLOR,"circle"],						#POI #2, flag "eecc22"
+	"1899":["special_marker",KMLCOLOR,"circle"],							#POI #3, pin "eecc22"
+	"1502":["special_star",KMLCOLOR,"circle"],								#POI #4, star "eecc22"
+	"1501":["special_symbol_plus",KMLCOLOR,"circle"],						#POI #5, plus/diamond "eecc22"
+	"1500":["special_flag_start",KMLCOLOR,"circle"],						#POI #6, square in google maps & square flag i OSMAnd
+	"1592":["special_heart",KMLCOLOR,"circle"],								#POI #7, heart
+	"1729":["tourism_viewpoint",KMLCOLOR,"circle"],							#Vista point / viewpoint
+	"503": ["special_marker",KMLCOLOR,"circle"],							#Old school map point
+	"1603":["special_house","eecc22","circle"],								#house
+	"1879":["amenity_biergarten",KMLCOLOR,"circle"],						#brewery, brew pub
+	"1541":["special_symbol_exclamation_mark","ff0000","octagon"],			#danger #1 GMaps: "!" 		OSMAnd: exclamation
+	"1898":["special_symbol_exclamation_mark",KMLCOLOR,"octagon"],			#danger #1 GMaps: "X" 		OSMAnd: exclamation 
+	"1564":["amenity_fire_station","ff0000","octagon"],						#danger #2 GMaps: 			OSMAnd: fire/explosion
+	"1710":["special_arrow_up_and_down","10c0f0","circle"],					#river gauge, up/down arrow or thermometer
+	"1655":["amenity_police","1010a0","circle"],							#ranger/police station #1
+	"1657":["amenity_police","1010a0","circle"],							#ranger/police station #2
+	"1720":["wood","eecc22","circle"],										#Park/National Park - yellow
+	"1701":["sport_swimming","eecc22","circle"],							#Lake/swimmer - yellow
+	"1395":["sport_swimming","eecc22","circle"],							#Lake/swimmer - yellow, old style icon
+	"1811":["special_sun","eecc22","circle"],								#hot spring/sun - yellow
+	"1716":["route_railway_ref",KMLCOLOR,"circle"],							#train station - purple
+	"1532":["route_bus_ref",KMLCOLOR,"circle"],								#bus station or stop
+	"1626":["route_monorail_ref",KMLCOLOR,"circle"],						#Metro, subway stop
+	"1534":["amenity_cafe",KMLCOLOR,"circle"],								#cafe/coffe - blue
+	"1607":["amenity_cafe",KMLCOLOR,"circle"],								#cafe/coffe - blue, old style ice cream cone icon
+	"1892":["waterfall","eecc22","circle"],									#waterfall - yellow
+	"1634":["building_type_pyramid","eecc22","circle"],						#Mountain Peak - yellow
+	"1684":["shop_department_store","10c0f0","circle"],						#Store/shopping - blue
+	"1095":["shop_department_store","10c0f0","circle"],						#Store/shopping - blue	old style shopping icon
+	"1517":["amenity_bar",KMLCOLOR,"circle"],								#Bar/cocktails/lounge - blue, old style icon
+	"979": ["special_sail_boat","a71de1","circle"],							#Passenger ferry - purple
+	"1537":["special_sail_boat",KMLCOLOR,"circle"],							#Auto Ferry
+	"1498":["place_town","0244D1","circle"],								#town/city/village - Google circle with small square in center
+	"1521":["leisure_beach_resort","eecc22","circle"],						#beach - yellow
+	"1703":["amenity_drinking_water","00842b","circle"],					#Water Faucet - green
+	"1781":["sanitary_dump_station","10c0f0","circle"],						#RV Dump station - light blue
+	"1798":["Winery",KMLCOLOR,"circle"],									#Winery - light blue
+	"1636":["Museum",KMLCOLOR,"circle"],									#Museum - light blue
+	"1289":["Museum","10c0f0","circle"],									#Museum - light blue, old style icon
+	"1741":["special_wagon","10c0f0","circle"],								#car rental - light blue
+	"1590":["shop_car_repair","10c0f0","circle"],							#car/tire repair - light blue
+	"1659":["amenity_post_box","10c0f0","circle"],							#post office
+	"1512":["amenity_atm","10c0f0","circle"],								#bank/atm
+	"1870":["sport_scuba_diving",KMLCOLOR,"octagon"],						#scuba, dive, snorkel site, google maps - snorkel mask, OSMAnd scuba diver
+	"1882":["reef",KMLCOLOR,"octagon"],										#reef, tide pool - google maps starfish icon, OSMAnd seahorse/coral
+	"1573":["reef",KMLCOLOR,"octagon"],										#reef, tide pool, fishing spot - google maps fish icon, OSMAnd seahorse/coral
+	"1569":["special_sail_boat",KMLCOLOR,"circle"],							#Passenger Ferry
+	"1741":["special_wagon",KMLCOLOR,"circle"],								#Car Rental
+	"1538":["special_wagon",KMLCOLOR,"circle"],								#Car Rental
+	"1709":["amenity_cinema",KMLCOLOR,"circle"],							#Cinema, movie, theater
+	"1615":["sport_canoe",KMLCOLOR,"circle"],								#Kayak, kayak rental
+	"1598":["historic_castle",KMLCOLOR,"circle"],							#castle, ruins
+	"1670":["building_type_church",KMLCOLOR,"circle"],						#church, mosque, temple
+	"1877":["special_arrow_up_arrow_down",KMLCOLOR,"circle"],				#stairway, for OSMAnd it's up/down arrow icon
+}
+# The iconDictionary entries as shared, read only, cWaypoint records.  Built once when
+# the program starts instead of on every waypoint.  The records must not be changed.
+ICON_TABLE = types.MappingProxyType({KMLIconID: cWaypoint(*entry) for KMLIconID, entry in iconDictionary.items()})
+#========================================================================================
+# KMLToOSMAndIcon
+# Returns the shared ICON_TABLE record for a KML icon number, or the "unknown" record
+# if the icon number is not in the table.
+#========================================================================================
 def KMLToOSMAndIcon(KMLIconID):
-
-	iconDictionary ={
-		"unknown":["special_symbol_question_mark","e044bb","octagon"],			#unknown KML icon code - this entry will be used if the KML icon is not found the iconDictionary.
-		"1765":["tourism_camp_site",KMLCOLOR,"circle"],							#campsite
-		"1525":["leisure_marina","a71de1","octagon"],							#river access
-		"1739":["special_number_0",KMLCOLOR,"circle"],							#Mileage marker plus-KML dot on gmaps & Plus in OSMAnd. Did have this color:"1010a0"
-		"1596":["special_trekking",KMLCOLOR,"circle"],							#hiking trailhead  Color I use is 9E963A
-		"1369":["special_trekking",KMLCOLOR,"circle"],							#hiking trailhead -old style icon
-		"1371":["special_trekking",KMLCOLOR,"circle"],							#hiking trailhead -old style icon
-		"1723":["tourism_viewpoint",KMLCOLOR,"octagon"],						#rapid  "d90000"
-		"1602":["tourism_hotel",KMLCOLOR,"circle"],								#hotel, lodge
-		"1528":["bridge_structure_suspension","10c0f0","circle"],				#bridge
-		"1577":["restaurants",KMLCOLOR,"circle"],								#retaurant, diner, dining
-		"1085":["restaurants",KMLCOLOR,"circle"],								#retaurant, diner, dining, old style icon
-		"1650":["tourism_picnic_site","eecc22","circle"],						#picnic site
-		"1644":["amenity_parking",KMLCOLOR,"circle"],							#parking area
-		"1578":["shop_supermarket",KMLCOLOR,"circle"],							#grocery store, supermarket #1 - light blue "10c0f0"
-		"1685":["shop_supermarket",KMLCOLOR,"circle"],							#grocery store, supermarket #2 - light blue	"10c0f0"
-		"1023":["shop_supermarket",KMLCOLOR,"circle"],							#grocery store, supermarket #2 - light blue	"10c0f0", old style grocery icon
-		"1504":["air_transport","10c0f0","circle"],								#airport, airstrip
-		"1581":["fuel",KMLCOLOR,"circle"],										#gas station
-		"1733":["amenity_toilets","10c0f0","circle"],							#toilet, restroom
-		"1624":["amenity_doctors","d00d0d","circle"],							#hospital, doctor, emergency room
-		"1608":["tourism_information","1010a0","circle"],						#tourism information
-		"1203":["tourism_information","1010a0","circle"],						#tourism information, old style icon - big "i"
-		"1535":["special_photo_camera",KMLCOLOR,"circle"],						#POI #1, camera "eecc22"
-		"993": ["special_photo_camera",KMLCOLOR,"circle"],						#POI #1, camera "eecc22" old icon style
-		"1574":["special_flag_start",KMLCOLOR,"circle"],						#POI #2, flag "eecc22"
-		"1899":["special_marker",KMLCOLOR,"circle"],							#POI #3, pin "eecc22"
-		"1502":["special_star",KMLCOLOR,"circle"],								#POI #4, star "eecc22"
-		"1501":["special_symbol_plus",KMLCOLOR,"circle"],						#POI #5, plus/diamond "eecc22"
-		"1500":["special_flag_start",KMLCOLOR,"circle"],						#POI #6, square in google maps & square flag i OSMAnd
-		"1592":["special_heart",KMLCOLOR,"circle"],								#POI #7, heart
-		"1729":["tourism_viewpoint",KMLCOLOR,"circle"],							#Vista point / viewpoint
-		"503": ["special_marker",KMLCOLOR,"circle"],							#Old school map point
-		"1603":["special_house","eecc22","circle"],								#house
-		"1879":["amenity_biergarten",KMLCOLOR,"circle"],						#brewery, brew pub
-		"1541":["special_symbol_exclamation_mark","ff0000","octagon"],			#danger #1 GMaps: "!" 		OSMAnd: exclamation
-		"1898":["special_symbol_exclamation_mark",KMLCOLOR,"octagon"],			#danger #1 GMaps: "X" 		OSMAnd: exclamation 
-		"1564":["amenity_fire_station","ff0000","octagon"],						#danger #2 GMaps: 			OSMAnd: fire/explosion
-		"1710":["special_arrow_up_and_down","10c0f0","circle"],					#river gauge, up/down arrow or thermometer
-		"1655":["amenity_police","1010a0","circle"],							#ranger/police station #1
-		"1657":["amenity_police","1010a0","circle"],							#ranger/police station #2
-		"1720":["wood","eecc22","circle"],										#Park/National Park - yellow
-		"1701":["sport_swimming","eecc22","circle"],							#Lake/swimmer - yellow
-		"1395":["sport_swimming","eecc22","circle"],							#Lake/swimmer - yellow, old style icon
-		"1811":["special_sun","eecc22","circle"],								#hot spring/sun - yellow
-		"1716":["route_railway_ref",KMLCOLOR,"circle"],							#train station - purple
-		"1532":["route_bus_ref",KMLCOLOR,"circle"],								#bus station or stop
-		"1626":["route_monorail_ref",KMLCOLOR,"circle"],						#Metro, subway stop
-		"1534":["amenity_cafe",KMLCOLOR,"circle"],								#cafe/coffe - blue
-		"1607":["amenity_cafe",KMLCOLOR,"circle"],								#cafe/coffe - blue, old style ice cream cone icon
-		"1892":["waterfall","eecc22","circle"],									#waterfall - yellow
-		"1634":["building_type_pyramid","eecc22","circle"],						#Mountain Peak - yellow
-		"1684":["shop_department_store","10c0f0","circle"],						#Store/shopping - blue
-		"1095":["shop_department_store","10c0f0","circle"],						#Store/shopping - blue	old style shopping icon
-		"1517":["amenity_bar",KMLCOLOR,"circle"],								#Bar/cocktails/lounge - blue, old style icon
-		"979": ["special_sail_boat","a71de1","circle"],							#Passenger ferry - purple
-		"1537":["special_sail_boat",KMLCOLOR,"circle"],							#Auto Ferry
-		"1498":["place_town","0244D1","circle"],								#town/city/village - Google circle with small square in center
-		"1521":["leisure_beach_resort","eecc22","circle"],						#beach - yellow
-		"1703":["amenity_drinking_water","00842b","circle"],					#Water Faucet - green
-		"1781":["sanitary_dump_station","10c0f0","circle"],						#RV Dump station - light blue
-		"1798":["Winery",KMLCOLOR,"circle"],									#Winery - light blue
-		"1636":["Museum",KMLCOLOR,"circle"],									#Museum - light blue
-		"1289":["Museum","10c0f0","circle"],									#Museum - light blue, old style icon
-		"1741":["special_wagon","10c0f0","circle"],								#car rental - light blue
-		"1590":["shop_car_repair","10c0f0","circle"],							#car/tire repair - light blue
-		"1659":["amenity_post_box","10c0f0","circle"],							#post office
-		"1512":["amenity_atm","10c0f0","circle"],								#bank/atm
-		"1870":["sport_scuba_diving",KMLCOLOR,"octagon"],						#scuba, dive, snorkel site, google maps - snorkel mask, OSMAnd scuba diver
-		"1882":["reef",KMLCOLOR,"octagon"],										#reef, tide pool - google maps starfish icon, OSMAnd seahorse/coral
-		"1573":["reef",KMLCOLOR,"octagon"],										#reef, tide pool, fishing spot - google maps fish icon, OSMAnd seahorse/coral
-		"1569":["special_sail_boat",KMLCOLOR,"circle"],							#Passenger Ferry
-		"1741":["special_wagon",KMLCOLOR,"circle"],								#Car Rental
-		"1538":["special_wagon",KMLCOLOR,"circle"],								#Car Rental
-		"1709":["amenity_cinema",KMLCOLOR,"circle"],							#Cinema, movie, theater
-		"1615":["sport_canoe",KMLCOLOR,"circle"],								#Kayak, kayak rental
-		"1598":["historic_castle",KMLCOLOR,"circle"],							#castle, ruins
-		"1670":["building_type_church",KMLCOLOR,"circle"],						#church, mosque, temple
-		"1877":["special_arrow_up_arrow_down",KMLCOLOR,"circle"],				#stairway, for OSMAnd it's up/down arrow icon
-	}
-	
-	waypt = cWaypoint("unknown",KMLCOLOR,"circle")
-
-	if not KMLIconID in iconDictionary:
-		KMLIconID = "unknown"
-	waypt.icon = iconDictionary[KMLIconID][0]
-	if iconDictionary[KMLIconID][1] == KMLCOLOR:
-		#use the icon color from the KML file
-		waypt.color = KMLCOLOR
-	else:
-		#use the icon color from the dictionary table
-		waypt.color = iconDictionary[KMLIconID][1]
-	waypt.background = iconDictionary[KMLIconID][2]
+	waypt = ICON_TABLE.get(KMLIconID)
+	if waypt is None:
+		waypt = ICON_TABLE["unknown"]
 	#print("icon:", waypt.icon, "color:", waypt.color, "background:",waypt.background)
 	return(waypt)
 #========================================================================================
+# resolveWaypointIcon
+# Returns the cWaypoint with the final OSMAnd icon, color and background for a KML icon
+# number and the color field from the styleUrl (None if the styleUrl has no color field).
+# The results are cached, so each style used in a map is only worked out once.
+#========================================================================================
+@functools.lru_cache(maxsize=None)
+def resolveWaypointIcon(KMLIconID,styleColor):
+	waypt = KMLToOSMAndIcon(KMLIconID)
+	if waypt.color != KMLCOLOR:
+		#use the icon color from the dictionary table
+		return(waypt)
+	#use the icon color from the KML file
+	if styleColor is None or styleColor == "labelson":  # there is no color value in styleURL string
+		return(cWaypoint(waypt.icon,DEFAULT_ICON_COLOR,waypt.background))
+	return(cWaypoint(waypt.icon,styleColor,waypt.background))
+#========================================================================================
 # addFileExtensionsTags
 #========================================================================================
 def addFileExtensionsTags(gpx,args):
@@ -273,17 +966,208 @@ def addFileExtensionsTags(gpx,args):
 		ET.SubElement(extensions, "osmand:split_interval").text = str(int(float(args.split) * 1609.34))
 	return
 #========================================================================================
+# cGPXWriter
+# Writes GPX elements straight to an open file, indented the same way minidom's
+# toprettyxml did it.  This replaces building the whole document as a string with
+# ET.tostring, parsing it again with minidom and pretty printing it.  Tracks (cTrack) are
+# written straight from their trackpoint arrays.  args gives the --precision and
+# --drop-zero-ele options for the trackpoints.
+#========================================================================================
+GPX_INDENT = "  "
+class cGPXWriter:
+	def __init__ (self,f,args=None):
+		self.f = f
+		self.precision = args.precision if args is not None else None
+		self.dropZeroEle = args.drop_zero_ele if args is not None else False
+	def writeDeclaration(self):
+		self.f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+	def startTag(self,element):
+		# namespace declarations come first, as minidom wrote them
+		attributes = sorted(element.items(), key=lambda item: not item[0].startswith("xmlns"))
+		return("<" + element.tag + "".join(' %s="%s"' % (name, escape(value,{'"':"&quot;"})) for name, value in attributes))
+	def startElement(self,element,level):
+		self.f.write(GPX_INDENT * level + self.startTag(element) + ">\n")
+	def endElement(self,element,level):
+		self.f.write(GPX_INDENT * level + "</" + element.tag + ">\n")
+	def writeElement(self,element,level):
+		if len(element) == 0:
+			if element.text:
+				self.f.write(GPX_INDENT * level + self.startTag(element) + ">" + escape(element.text,{'"':"&quot;"}) + "</" + element.tag + ">\n")
+			else:
+				self.f.write(GPX_INDENT * level + self.startTag(element) + "/>\n")
+			return
+		self.startElement(element,level)
+		for child in element:
+			if child.tag == "trkseg" and isinstance(element,cTrack):
+				self.writeTrackSegment(element,level + 1)
+			else:
+				self.writeElement(child,level + 1)
+		self.endElement(element,level)
+	def writeTrackSegment(self,track,level):
+		indent = GPX_INDENT * level
+		if track.countPoints() == 0:
+			self.f.write(indent + "<trkseg/>\n")
+			return
+		# The lat/lon values are written with repr(), the shortest text that reads back as the same
+		# float.  That is the KML value, but not always its text: 38.8170200 is written as
+		# 38.81702 and -120 as -120.0.
+		if self.precision is None:
+			lat = track.lat.tolist()
+			lon = track.lon.tolist()
+		else:
+			# rounded all at once, repr() then leaves off any trailing zeros
+			lat = roundCoordinates(track.lat,self.precision)
+			lon = roundCoordinates(track.lon,self.precision)
+		self.f.write(indent + "<trkseg>\n")
+		if self.dropZeroEle and not anyNonZero(track.ele):
+			trackpoint = indent + GPX_INDENT + '<trkpt lat="%r" lon="%r"/>\n'
+			self.f.writelines(trackpoint % point for point in zip(lat,lon))
+		else:
+			trackpoint = (indent + GPX_INDENT + '<trkpt lat="%r" lon="%r">\n'
+				+ indent + GPX_INDENT * 2 + '<ele>%.1f</ele>\n'
+				+ indent + GPX_INDENT + '</trkpt>\n')
+			self.f.writelines(trackpoint % point for point in zip(lat,lon,track.ele.tolist()))
+		self.f.write(indent + "</trkseg>\n")
+#========================================================================================
+# anyNonZero
+# True if any of the values isn't 0, checked in one numpy call when they are a numpy array.
+#========================================================================================
+def anyNonZero(values):
+	if numpy is not None and isinstance(values,numpy.ndarray):
+		return(bool(values.any()))
+	return(any(values))
+#========================================================================================
+# roundCoordinates
+# The values rounded to precision decimal places, as a list of python floats.  Both paths
+# round value * 10**precision to the nearest integer, ties to even, and divide it back down
+# the way numpy.round does, so the output is the same with or without numpy.
+#========================================================================================
+def roundCoordinates(values,precision):
+	if numpy is not None:
+		return(numpy.round(numpy.asarray(values),precision).tolist())
+	scale = 10.0 ** precision
+	return([math.copysign(round(value * scale), value) / scale for value in values])
+#========================================================================================
+# outputCompression
+# How the GPX files are compressed: the --compress option, or with auto, gzip for a
+# gpx_file ending in .gz and zip for one ending in .zip.
+#========================================================================================
+def outputCompression(args):
+	if args is None:
+		return(COMPRESS_NONE)
+	if args.compress != COMPRESS_AUTO:
+		return(args.compress)
+	for compression in (COMPRESS_GZIP, COMPRESS_ZIP):
+		if args.gpx_file.lower().endswith(COMPRESS_EXTENSIONS[compression]):
+			return(compression)
+	return(COMPRESS_NONE)
+#========================================================================================
+# cCompressedGPXFile
+# Text file the GPX XML is written to through gzip or zip compression, as it is written,
+# so the whole file is never held in memory.  Closing it finishes the compression and
+# closes everything underneath it.
+#========================================================================================
+class cCompressedGPXFile(io.TextIOWrapper):
+	def __init__ (self,compressed,closeAfter):
+		io.TextIOWrapper.__init__(self,compressed,encoding="utf-8")
+		self.closeAfter = closeAfter	# closed, in order, once the compressed stream is
+	def close(self):
+		if self.closed:
+			return
+		io.TextIOWrapper.close(self)
+		for f in self.closeAfter:
+			f.close()
+#========================================================================================
+# openGPXFile
+# Open the GPX file for writing, or stdout if it is "-".  Closing stdout's file only
+# flushes it, stdout stays open.  With args the file is compressed as the --compress
+# and --compress-level options say.  A zip file holds one GPX file named after it.
+#========================================================================================
+def openGPXFile(outputFilename,args=None):
+	compression = outputCompression(args)
+	if outputFilename == STDIO_FILENAME:
+		sys.stdout.flush()
+		if compression == COMPRESS_NONE:
+			return(open(sys.stdout.fileno(),"w",encoding="utf-8",closefd=False))
+		f = open(sys.stdout.fileno(),"wb",closefd=False)
+	elif compression == COMPRESS_NONE:
+		return(open(outputFilename,"w",encoding="utf-8"))
+	else:
+		f = open(outputFilename,"wb")
+	if compression == COMPRESS_GZIP:
+		compressed = gzip.GzipFile(filename=ntpath.basename(outputFilename),mode="wb",compresslevel=args.compress_level,fileobj=f)
+		return(cCompressedGPXFile(compressed,[f]))
+	member = ntpath.basename(outputFilename)
+	if member.lower().endswith(COMPRESS_EXTENSIONS[COMPRESS_ZIP]):
+		member = member[:-len(COMPRESS_EXTENSIONS[COMPRESS_ZIP])]
+	if member == STDIO_FILENAME:
+		member = "KMLtoOSMAndGPX"
+	if not member.lower().endswith(".gpx"):
+		member += ".gpx"
+	archive = zipfile.ZipFile(f,"w",compression=zipfile.ZIP_DEFLATED,compresslevel=args.compress_level)
+	# opened by name the member would be dated 1980-01-01
+	info = zipfile.ZipInfo(member,time.localtime()[:6])
+	info.compress_type = zipfile.ZIP_DEFLATED
+	return(cCompressedGPXFile(archive.open(info,"w",force_zip64=True),[archive,f]))
+#========================================================================================
 # writeGPXFile
 #========================================================================================
-def writeGPXFile(gpx,outputFilename):
-	# Create the ElementTree object with pretty printing options
-	tree = ET.ElementTree(gpx)
-	tree_str = ET.tostring(gpx, encoding="utf-8", xml_declaration=True)
-	pretty_tree_str = minidom.parseString(tree_str).toprettyxml(indent="  ", encoding="utf-8").decode()
-
-	# Write the pretty-printed GPX XML to a file
-	with open(outputFilename, "w",encoding="utf-8") as f:
-		f.write(pretty_tree_str)
+def writeGPXFile(gpx,outputFilename,args=None):
+	# Write the indented GPX XML straight to the file
+	with openGPXFile(outputFilename,args) as f:
+		writer = cGPXWriter(f,args)
+		writer.writeDeclaration()
+		writer.writeElement(gpx,0)
+#========================================================================================
+# cGPXStream
+# Stands in for the gpx element when the -i flag is specified.  Each waypoint or track
+# appended to it is written to the GPX file right away and can then be released, so a
+# converted map is never held in memory.  The file-level extensions only depend on the
+# command line arguments, so they are written as the footer when the stream is closed.
+# The file is not created until something is written to it, and is then added to the
+# conversion's outputFiles.  If the conversion fails the conversion aborts the stream, so a
+# GPX file cut off part way through isn't left behind.
+#========================================================================================
+class cGPXStream:
+	def __init__ (self,outputFilename,conversion):
+		self.outputFilename = outputFilename
+		self.outputFiles = conversion.outputFiles
+		self.args = conversion.args
+		self.gpx = addGPXElement()
+		self.writer = None
+		self.closed = False
+		conversion.streams.append(self)
+	def open(self):
+		if self.writer is None:
+			self.outputFiles.append(self.outputFilename)
+			self.writer = cGPXWriter(openGPXFile(self.outputFilename,self.args),self.args)
+			self.writer.writeDeclaration()
+			self.writer.startElement(self.gpx,0)
+	def append(self,element):
+		self.open()
+		self.writer.writeElement(element,1)
+	def extend(self,elements):
+		for element in elements:
+			self.append(element)
+	def close(self,args):
+		self.open()
+		addFileExtensionsTags(self.gpx,args)
+		for element in self.gpx:
+			self.writer.writeElement(element,1)
+		self.writer.endElement(self.gpx,0)
+		self.writer.f.close()
+		self.closed = True
+	def abort(self):
+		if self.closed or self.writer is None:
+			return
+		self.closed = True
+		try:
+			self.writer.f.close()
+		except Exception:
+			pass	# the error that aborted the conversion is the one reported
+		self.outputFiles.remove(self.outputFilename)
+		if self.outputFilename != STDIO_FILENAME:
+			os.remove(self.outputFilename)
 #========================================================================================
 # addGPXElement
 #========================================================================================
@@ -299,40 +1183,193 @@ def addGPXElement():
 	gpx.set("creator", "KMLtoOSMAndGPX")
 	return(gpx)
 #========================================================================================
+# openKMLFile
+# Returns a binary file object for the KML data.  A KMZ file is a zip archive and the KML
+# is streamed straight out of the archive member, nothing is extracted to disk.  The KML
+# in a KMZ file is doc.kml, or if there isn't one, the first .kml file in the archive.
+# filename "-" reads the KML or KMZ file from stdin.
+#========================================================================================
+def openKMLFile(filename):
+	if filename == STDIO_FILENAME:
+		# stdin itself stays open once the KML file has been read
+		source = open(sys.stdin.fileno(),"rb",closefd=False)
+		if not source.peek(len(ZIP_SIGNATURE)).startswith(ZIP_SIGNATURE):
+			return(source)
+		# zipfile has to seek, so a KMZ file piped in is read into memory first
+		with source:
+			archiveFile = io.BytesIO(source.read())
+	elif zipfile.is_zipfile(filename):
+		archiveFile = filename
+	else:
+		return(open(filename,"rb"))
+	with zipfile.ZipFile(archiveFile) as archive:
+		# the member stays readable after the archive is closed, until it is closed itself
+		return(archive.open(kmzMember(archive,filename)))
+#========================================================================================
+# kmzMember
+# The KML file in a KMZ file: doc.kml, or else the first .kml file in it.
+#========================================================================================
+def kmzMember(archive,filename):
+	members = [name for name in archive.namelist() if name.lower().endswith(".kml")]
+	if not members:
+		raise ValueError("No KML file found in KMZ file: " + filename)
+	if "doc.kml" in members:
+		return("doc.kml")
+	return(members[0])
+#========================================================================================
+# kmlFileSize
+# The number of bytes of KML that will be read from the file, uncompressed for KMZ files.
+# None for stdin, its size isn't known until it has all been read.
+#========================================================================================
+def kmlFileSize(filename):
+	if filename == STDIO_FILENAME:
+		return(None)
+	if not zipfile.is_zipfile(filename):
+		return(os.path.getsize(filename))
+	with zipfile.ZipFile(filename) as archive:
+		return(archive.getinfo(kmzMember(archive,filename)).file_size)
+#========================================================================================
+# iterKMLPlacemarks
+# Stream the KML file with iterparse instead of building the whole tree with ET.parse.
+# Yields (EVENT_PLACEMARK, folder, placemark) for each completed <Placemark>, where folder
+# is the innermost enclosing cKMLFolder or None for placemarks at the <Document> level,
+# and (EVENT_FOLDER_END, folder, None) when a folder closes.  Folders are added to index.
+# The backend (cStdlibBackend or cLxmlBackend) supplies the iterparse.  The cProgress, if
+# given, is told how much of the file has been read.
+# Everything directly under <Document> or a <Folder> is removed from the tree once it has
+# been handed out, so peak memory depends on the largest single placemark and not on the
+# size of the KML file.
+#========================================================================================
+def iterKMLPlacemarks(filename,index,backend,progress=None):
+	with openKMLFile(filename) as source:
+		if progress is not None:
+			progress.start(source,kmlFileSize(filename))
+		elements = []	# currently open elements, outermost first
+		folders = []	# currently open folders, outermost first
+		for event, element in backend.iterparse(source):
+			if event == "start":
+				elements.append(element)
+				if element.tag == KML_FOLDER:
+					folders.append(index.addFolder(folders[-1] if folders else None))
+				continue
+			elements.pop()
+			parent = elements[-1] if elements else None
+			if element.tag == KML_PLACEMARK:
+				yield(EVENT_PLACEMARK, folders[-1] if folders else None, element)
+			elif element.tag == KML_FOLDER:
+				yield(EVENT_FOLDER_END, folders.pop(), None)
+			elif element.tag == KML_NAME and parent is not None and parent.tag == KML_FOLDER:
+				folders[-1].name = element.text or ""
+			if parent is not None and parent.tag in (KML_DOCUMENT, KML_FOLDER):
+				parent.remove(element)
+#========================================================================================
+# classifyPlacemark
+# Walk the placemark's subtree once, in document order, picking up the name, description,
+# styleUrl and the Point and LineString coordinates.  This replaces a separate ".//" search
+# for each of them in both processWaypoint and processTrack.
+#========================================================================================
+def classifyPlacemark(placemark):
+	info = cPlacemark()
+	stack = [(child, KML_PLACEMARK) for child in reversed(placemark)]
+	while stack:
+		element, parentTag = stack.pop()
+		tag = element.tag
+		if tag == KML_COORDINATES:
+			if parentTag == KML_POINT and info.point is None:
+				info.point = element.text or ""
+			elif parentTag == KML_LINESTRING and info.linestring is None:
+				info.linestring = element.text or ""
+		elif tag == KML_NAME:
+			if info.name is None:
+				info.name = element.text or ""
+		elif tag == KML_DESCRIPTION:
+			if info.description is None:
+				info.description = element.text or ""
+		elif tag == KML_STYLEURL:
+			if info.styleUrl is None:
+				info.styleUrl = element.text or ""
+		stack.extend((child, tag) for child in reversed(element))
+	return(info)
+#========================================================================================
+# cStdlibBackend
+# Parser backend using xml.etree from the python standard library.
+#========================================================================================
+class cStdlibBackend:
+	name = BACKEND_STDLIB
+	def iterparse(self,source):
+		return(ET.iterparse(source, events=("start","end")))
+	def classify(self,placemark):
+		return(classifyPlacemark(placemark))
+#========================================================================================
+# cLxmlBackend
+# Parser backend using lxml, when it is installed.  The placemark lookups are compiled
+# once into ETXPath objects instead of going through ElementPath on every call.
+#========================================================================================
+class cLxmlBackend:
+	name = BACKEND_LXML
+	def __init__ (self):
+		self.xpathPoint = lxmlET.ETXPath("(.//" + KML_POINT + "/" + KML_COORDINATES + ")[1]")
+		self.xpathLinestring = lxmlET.ETXPath("(.//" + KML_LINESTRING + "/" + KML_COORDINATES + ")[1]")
+		self.xpathName = lxmlET.ETXPath("(.//" + KML_NAME + ")[1]")
+		self.xpathDescription = lxmlET.ETXPath("(.//" + KML_DESCRIPTION + ")[1]")
+		self.xpathStyleUrl = lxmlET.ETXPath("(.//" + KML_STYLEURL + ")[1]")
+	def iterparse(self,source):
+		# huge_tree: a long track is a single <coordinates> text node that can be many MB
+		return(lxmlET.iterparse(source, events=("start","end"), huge_tree=True))
+	def classify(self,placemark):
+		info = cPlacemark()
+		info.point = self.firstText(self.xpathPoint,placemark)
+		info.linestring = self.firstText(self.xpathLinestring,placemark)
+		info.name = self.firstText(self.xpathName,placemark)
+		info.description = self.firstText(self.xpathDescription,placemark)
+		info.styleUrl = self.firstText(self.xpathStyleUrl,placemark)
+		return(info)
+	def firstText(self,xpath,placemark):
+		found = xpath(placemark)
+		if not found:
+			return(None)
+		return(found[0].text or "")
+#========================================================================================
+# selectBackend
+# Returns the parser backend for the --backend option, falling back to the standard
+# library when lxml was asked for but is not installed.
+#========================================================================================
+def selectBackend(name,log):
+	if name == BACKEND_STDLIB:
+		return(cStdlibBackend())
+	if lxmlET is None:
+		if name == BACKEND_LXML:
+			log.printLog(LOG_WARNING,"lxml is not installed, using the python standard library parser")
+		return(cStdlibBackend())
+	return(cLxmlBackend())
+#========================================================================================
 # processWaypoint
 #========================================================================================
-def processWaypoint(placemark,gpx):
-	global countFolderWaypoints
-	global countTotalWaypoints
+def processWaypoint(placemark,gpx,log):
 	# Get the coordinates from the KML Point element
-	point = placemark.find(".//{http://www.opengis.net/kml/2.2}Point/{http://www.opengis.net/kml/2.2}coordinates")
-	if point is not None:
-		countFolderWaypoints += 1
-		countTotalWaypoints += 1
-		coordinates = point.text.strip().split(",")
+	if placemark.point is not None:
+		coordinates = placemark.point.strip().split(",")
 		longitude = coordinates[0]
 		latitude = coordinates[1]
 		elevation = f"{float(coordinates[2]):.1f}"
 		#print("long",longitude, "lat",latitude,"elev",elevation)
 
 		# Create the GPX Waypoint element
-		waypoint = ET.SubElement(gpx, "wpt", lat=latitude, lon=longitude)
+		waypoint = ET.Element("wpt", lat=latitude, lon=longitude)
 		# Add the name and description from the KML Placemark element, if available
 
 		# add elevation
 		ET.SubElement(waypoint,"ele").text = elevation
 
-		name = placemark.find(".//{http://www.opengis.net/kml/2.2}name")
-		if name is not None:
-			#name = html_escape(name.text.strip())
-			name = name.text.strip()
-			print("      WayPt:",name)
+		if placemark.name is not None:
+			#name = html_escape(placemark.name.strip())
+			name = placemark.name.strip()
+			log.printLog(LOG_DEBUG,"      WayPt:",name)
 			ET.SubElement(waypoint, "name").text = name
 
-		description = placemark.find(".//{http://www.opengis.net/kml/2.2}description")
-		if description is not None:
-			#description = html_escape(description.text.strip())
-			description = description.text.strip()
+		if placemark.description is not None:
+			#description = html_escape(placemark.description.strip())
+			description = placemark.description.strip()
 			ET.SubElement(waypoint, "desc").text = description
 
 		# add extensions
@@ -344,66 +1381,406 @@ def processWaypoint(placemark,gpx):
 		#	<styleUrl>#icon-1369</styleUrl>
 		#	<styleUrl>#icon-1085-labelson</styleUrl>
 		#
-		# if there is no color field (get an exception on trying to access the field)
-		# then we will use the DEFAULT_ICON_COLOR value.  If the second field contains
-		# the string "labelson" we'll also use the DEFAULT_ICON_COLOR value.
-		style_url = placemark.findtext(".//{http://www.opengis.net/kml/2.2}styleUrl")
+		# if there is no color field then we will use the DEFAULT_ICON_COLOR value.  If the
+		# second field contains the string "labelson" we'll also use the DEFAULT_ICON_COLOR value.
+		style_url = placemark.styleUrl
 		if style_url:
 			style = style_url.split("-")
-			waypt = KMLToOSMAndIcon(style[1])
+			waypt = resolveWaypointIcon(style[1],style[2] if len(style) > 2 else None)
 		else:
-			waypt = KMLToOSMAndIcon("unknown")
-		#print("KMLToOSMAndIcon: icon:",waypt.icon,"color:",waypt.color,"background:",waypt.background)
+			waypt = resolveWaypointIcon("unknown",None)
+		#print("resolveWaypointIcon: icon:",waypt.icon,"color:",waypt.color,"background:",waypt.background)
 		ET.SubElement(extensions,"osmand:icon").text = waypt.icon
 		ET.SubElement(extensions,"osmand:background").text = waypt.background
-		if waypt.color == KMLCOLOR: # we use value from KML file
-			try:
-				if style[2] == "labelson":  # there is no color value in styleURL string
-					waypt.color = DEFAULT_ICON_COLOR
-				else:
-					waypt.color=style[2]
-			except IndexError:
-				waypt.color=DEFAULT_ICON_COLOR
 		ET.SubElement(extensions, "osmand:color").text = "#" + waypt.color
+		# Add the GPX Waypoint element to the GPX file
+		gpx.append(waypoint)
+		return(waypoint)
+	return(None)
+#========================================================================================
+# parseCoordinates
+# Convert the text of a KML <coordinates> tag, "lon,lat[,alt] lon,lat[,alt] ...", into
+# an (N,3) numpy array of lon, lat, altitude, parsed by numpy in a single call instead of
+# a split() and float() per point.  Tuples without an altitude get an altitude of 0.  The
+# number of commas tells whether every tuple has 3 values, or every tuple 2.
+#========================================================================================
+def parseCoordinates(text):
+	values = numpy.fromstring(text.replace(","," "), dtype=numpy.float64, sep=" ")
+	countCommas = text.count(",")
+	if 2 * len(values) == 3 * countCommas:
+		return(values.reshape(-1,3))
+	if len(values) == 2 * countCommas:
+		points = numpy.zeros((countCommas,3))
+		points[:,:2] = values.reshape(-1,2)
+		return(points)
+	# a mix of tuples with and without altitudes
+	coordinates = text.split()
+	points = numpy.zeros((len(coordinates),3))
+	for i, coordinate in enumerate(coordinates):
+		coordinate = coordinate.split(",")
+		points[i,:len(coordinate)] = numpy.array(coordinate, dtype=numpy.float64)
+	return(points)
+#========================================================================================
+# parseTrackpoints
+# Returns the lon, lat and altitude arrays for the text of a LineString's <coordinates>
+# tag.  Without numpy the coordinates are converted a point at a time.
+#========================================================================================
+def parseTrackpoints(text):
+	if numpy is not None:
+		points = parseCoordinates(text)
+		return(numpy.ascontiguousarray(points[:,0]),numpy.ascontiguousarray(points[:,1]),numpy.ascontiguousarray(points[:,2]))
+	lon = array.array("d")
+	lat = array.array("d")
+	ele = array.array("d")
+	# Iterate over the coordinates, "lon,lat[,alt]", and save each value
+	for coordinate in text.split():
+		values = coordinate.split(",")
+		lon.append(float(values[0]))
+		lat.append(float(values[1]))
+		if len(values) > 2:
+			ele.append(float(values[2]))
+		else:
+			ele.append(0.0)
+	return(lon,lat,ele)
+#========================================================================================
+# dedupeTrackpoints
+# With the --dedupe option, drops trackpoints that are closer than tolerance meters, the
+# --dedupe-distance option, to the trackpoint before them, which add to the file and the
+# drawing but not to the track.
+# With a tolerance of 0 only exact repeats of the same lon and lat are dropped.  Otherwise
+# a point is dropped if the distance along the track from the last point kept is less
+# than tolerance, so a run of short hops still keeps a point every tolerance meters.
+# The last point is always kept, in place of the point kept before it if that's too
+# close.  With numpy the comparisons and hop lengths are worked out in one go, leaving
+# only a loop over the short hops.
+# Returns the lon, lat and altitude arrays of the points kept.
+#========================================================================================
+def dedupeTrackpoints(lon,lat,ele,tolerance):
+	count = len(lat)
+	if count < 2:
+		return(lon,lat,ele)
+	if numpy is not None:
+		if tolerance <= 0:
+			keep = numpy.ones(count,dtype=bool)
+			keep[1:] = (lon[1:] != lon[:-1]) | (lat[1:] != lat[:-1])
+			return(lon[keep],lat[keep],ele[keep])
+		x, y = projectTrackpoints(lon,lat)
+		hops = numpy.hypot(numpy.diff(x),numpy.diff(y))
+		keep = numpy.ones(count,dtype=bool)
+		keep[1:] = hops >= tolerance
+		short = numpy.flatnonzero(hops < tolerance)
+		hops = hops[short].tolist()
+		short = short.tolist()
+	else:
+		if tolerance <= 0:
+			keep = [True] + [lon[i] != lon[i - 1] or lat[i] != lat[i - 1] for i in range(1, count)]
+			return(tuple(array.array("d",(value for value, flag in zip(values,keep) if flag)) for values in (lon,lat,ele)))
+		x, y = projectTrackpoints(lon,lat)
+		hops = [math.hypot(x[i + 1] - x[i],y[i + 1] - y[i]) for i in range(count - 1)]
+		keep = [True] + [hop >= tolerance for hop in hops]
+		short = [i for i, hop in enumerate(hops) if hop < tolerance]
+		hops = [hops[i] for i in short]
+	# hop i ends at point i + 1.  A long hop's point is kept and the distance starts over.
+	distance = 0.0
+	previous = -2
+	for i, hop in zip(short,hops):
+		if i != previous + 1:
+			distance = 0.0
+		previous = i
+		distance += hop
+		if distance >= tolerance:
+			keep[i + 1] = True
+			distance = 0.0
+	if not keep[-1]:
+		# the last point is less than tolerance from the last point kept, which is dropped
+		# instead, unless it's the first point
+		keep[-1] = True
+		i = count - 2
+		while i > 0 and not keep[i]:
+			i -= 1
+		keep[i] = i == 0
+	if numpy is not None:
+		return(lon[keep],lat[keep],ele[keep])
+	return(tuple(array.array("d",(value for value, flag in zip(values,keep) if flag)) for values in (lon,lat,ele)))
+#========================================================================================
+# simplifyTrackpoints
+# With the --simplify option, drops the trackpoints that the track's shape doesn't need,
+# using the Ramer-Douglas-Peucker algorithm: a section of track is replaced by a straight
+# line between its ends if no point in it is more than tolerance meters from that line,
+# otherwise it is split at the point furthest from the line and each half is checked the
+# same way.  The first and last points are always kept.  Distances are measured on a flat
+# projection of the track around its average latitude, which is accurate enough for
+# tolerances of meters to hundreds of meters.  With numpy the distances of all the points
+# in a section are worked out in one go.
+# Returns the lon, lat and altitude arrays of the points kept.
+#========================================================================================
+def simplifyTrackpoints(lon,lat,ele,tolerance):
+	if len(lat) < 3:
+		return(lon,lat,ele)
+	if numpy is not None:
+		x, y = projectTrackpoints(numpy.asarray(lon),numpy.asarray(lat))
+		keep = numpy.zeros(len(x),dtype=bool)
+		keep[[0,-1]] = True
+		sections = [(0, len(x) - 1)]
+		while sections:
+			first, last = sections.pop()
+			if last - first < 2:
+				continue
+			distances = segmentDistances2(x[first + 1:last] - x[first],y[first + 1:last] - y[first],x[last] - x[first],y[last] - y[first])
+			furthest = int(numpy.argmax(distances))
+			if distances[furthest] > tolerance * tolerance:
+				furthest += first + 1
+				keep[furthest] = True
+				sections.append((first, furthest))
+				sections.append((furthest, last))
+		return(lon[keep],lat[keep],ele[keep])
+	x, y = projectTrackpoints(lon,lat)
+	keep = {0, len(x) - 1}
+	sections = [(0, len(x) - 1)]
+	while sections:
+		first, last = sections.pop()
+		furthest = None
+		furthestDistance = tolerance * tolerance
+		for i in range(first + 1, last):
+			distance = segmentDistances2(x[i] - x[first],y[i] - y[first],x[last] - x[first],y[last] - y[first])
+			if distance > furthestDistance:
+				furthest = i
+				furthestDistance = distance
+		if furthest is not None:
+			keep.add(furthest)
+			sections.append((first, furthest))
+			sections.append((furthest, last))
+	keep = sorted(keep)
+	return(tuple(array.array("d",(values[i] for i in keep)) for values in (lon,lat,ele)))
+#========================================================================================
+# projectTrackpoints
+# x and y, in meters, of each point on a flat (equirectangular) projection around the
+# track's average latitude.  numpy arrays in, numpy arrays out, else lists.
+#========================================================================================
+def projectTrackpoints(lon,lat):
+	if numpy is not None and isinstance(lat,numpy.ndarray):
+		scale = math.cos(math.radians(float(lat.mean())))
+		return(numpy.radians(lon) * (EARTH_RADIUS_M * scale), numpy.radians(lat) * EARTH_RADIUS_M)
+	scale = math.cos(math.radians(sum(lat) / len(lat)))
+	return([math.radians(value) * EARTH_RADIUS_M * scale for value in lon], [math.radians(value) * EARTH_RADIUS_M for value in lat])
+#========================================================================================
+# segmentDistances2
+# Squared distance from the point(s) (px,py) to the segment from (0,0) to (dx,dy).  Works
+# on single values or numpy arrays of points.  Measuring to the segment, not the whole
+# line, keeps the far end of a track that doubles back on itself, or a closed loop whose
+# ends are the same point.
+#========================================================================================
+def segmentDistances2(px,py,dx,dy):
+	length2 = dx * dx + dy * dy
+	if length2 == 0:
+		return(px * px + py * py)
+	t = (px * dx + py * dy) / length2
+	if numpy is not None and isinstance(t,numpy.ndarray):
+		t = numpy.clip(t,0.0,1.0)
+	else:
+		t = min(max(t,0.0),1.0)
+	px = px - t * dx
+	py = py - t * dy
+	return(px * px + py * py)
+#========================================================================================
+# visvalingamAreas
+# How much each trackpoint matters to the track's shape, for the --max-track-points and
+# --max-points options, by the Visvalingam-Whyatt algorithm: the point making the smallest
+# triangle with its two neighbours is removed, its neighbours' triangles are worked out
+# again, and so on until only the ends are left.  A point's effective area is its triangle
+# when it was removed, in square meters, but never less than that of a point removed
+# before it.  Keeping the points with the largest effective areas gives the best shape for
+# the number of points kept.  The triangles are kept in a heap, so a track takes
+# O(n log n).  The ends of the track get an infinite area so they are always kept.
+#========================================================================================
+def visvalingamAreas(lon,lat):
+	count = len(lat)
+	if count < 3:
+		if numpy is not None:
+			return(numpy.full(count, math.inf))
+		return([math.inf] * count)
+	x, y = projectTrackpoints(lon,lat)
+	if numpy is not None and isinstance(x,numpy.ndarray):
+		# every point's first triangle in one go
+		triangles = numpy.abs((x[:-2] - x[1:-1]) * (y[2:] - y[1:-1]) - (x[2:] - x[1:-1]) * (y[:-2] - y[1:-1])) / 2
+		x = x.tolist()
+		y = y.tolist()
+		triangles = triangles.tolist()
+	else:
+		triangles = [abs((x[i - 1] - x[i]) * (y[i + 1] - y[i]) - (x[i + 1] - x[i]) * (y[i - 1] - y[i])) / 2 for i in range(1, count - 1)]
+	current = [math.inf] + triangles + [math.inf]
+	areas = [math.inf] * count
+	previous = list(range(-1, count - 1))
+	following = list(range(1, count + 1))
+	heap = [(area, i) for i, area in enumerate(current[1:-1], 1)]
+	heapq.heapify(heap)
+	largest = 0.0
+	while heap:
+		area, i = heapq.heappop(heap)
+		if area != current[i] or areas[i] != math.inf:
+			continue	# the point was removed, or its triangle changed after this was pushed
+		largest = max(largest, area)
+		areas[i] = largest
+		before = previous[i]
+		after = following[i]
+		following[before] = after
+		previous[after] = before
+		for j in (before, after):
+			if 0 < j < count - 1:
+				a = previous[j]
+				b = following[j]
+				current[j] = abs((x[a] - x[j]) * (y[b] - y[j]) - (x[b] - x[j]) * (y[a] - y[j])) / 2
+				heapq.heappush(heap,(current[j], j))
+	if numpy is not None:
+		return(numpy.array(areas))
+	return(areas)
+#========================================================================================
+# keepTrackpoints
+# Reduce the track's arrays, and its effective areas if it has them, to the points whose
+# keep flag is set.  keep is a numpy bool array, or a list without numpy.
+#========================================================================================
+def keepTrackpoints(track,keep):
+	if numpy is not None:
+		track.lon = track.lon[keep]
+		track.lat = track.lat[keep]
+		track.ele = track.ele[keep]
+		if track.areas is not None:
+			track.areas = track.areas[keep]
+		return
+	indices = [i for i, flag in enumerate(keep) if flag]
+	track.lon = array.array("d",(track.lon[i] for i in indices))
+	track.lat = array.array("d",(track.lat[i] for i in indices))
+	track.ele = array.array("d",(track.ele[i] for i in indices))
+	if track.areas is not None:
+		track.areas = [track.areas[i] for i in indices]
+#========================================================================================
+# largestAreas
+# keep flags for the budget points with the largest areas.  Effective areas are often
+# equal, so both paths use a stable sort and keep the later of the points with equal
+# areas, and the same points are kept with or without numpy.
+#========================================================================================
+def largestAreas(areas,budget):
+	count = len(areas)
+	budget = min(max(budget, 1), count)
+	if numpy is not None:
+		keep = numpy.zeros(count,dtype=bool)
+		keep[numpy.argsort(areas,kind="stable")[count - budget:]] = True
+		return(keep)
+	keep = [False] * count
+	for i in sorted(range(count),key=areas.__getitem__)[count - budget:]:
+		keep[i] = True
+	return(keep)
+#========================================================================================
+# budgetTrackpoints
+# With the --max-points option, reduce the tracks in a GPX file to budget trackpoints
+# between them.  The points kept are the ones with the largest effective areas across all
+# the tracks, so a track with a lot of detail keeps more of its points than a nearly
+# straight one.  The ends of every track are always kept, even if that's over the budget.
+# Returns the number of trackpoints removed and how much shorter the tracks are, in meters.
+#========================================================================================
+def budgetTrackpoints(gpx,args):
+	budget = args.max_points
+	tracks = [element for element in gpx if isinstance(element,cTrack) and element.countPoints() > 0]
+	countPoints = sum(track.countPoints() for track in tracks)
+	if countPoints <= budget:
+		return(0, 0.0)
+	length = sum(track.length for track in tracks)
+	if numpy is not None:
+		areas = numpy.concatenate([track.areas for track in tracks])
+		keep = largestAreas(areas,budget) | (areas == math.inf)
+	else:
+		areas = [area for track in tracks for area in track.areas]
+		keep = [flag or area == math.inf for flag, area in zip(largestAreas(areas,budget),areas)]
+	start = 0
+	for track in tracks:
+		end = start + track.countPoints()
+		keepTrackpoints(track,keep[start:end])
+		setTrackStats(track,args)
+		start = end
+	return(countPoints - sum(track.countPoints() for track in tracks), length - sum(track.length for track in tracks))
+#========================================================================================
+# trackLength
+# Length of the track in meters, the sum of the great circle (haversine) distances
+# between its trackpoints.  With numpy all the distances are worked out in one go.
+#========================================================================================
+def trackLength(lon,lat):
+	if len(lat) < 2:
+		return(0.0)
+	if numpy is not None:
+		lon = numpy.radians(lon)
+		lat = numpy.radians(lat)
+		a = numpy.sin(numpy.diff(lat) / 2) ** 2 + numpy.cos(lat[:-1]) * numpy.cos(lat[1:]) * numpy.sin(numpy.diff(lon) / 2) ** 2
+		return(float(2 * EARTH_RADIUS_M * numpy.arcsin(numpy.sqrt(numpy.minimum(a,1.0))).sum()))
+	length = 0.0
+	lon = [math.radians(value) for value in lon]
+	lat = [math.radians(value) for value in lat]
+	for i in range(1, len(lat)):
+		a = math.sin((lat[i] - lat[i - 1]) / 2) ** 2 + math.cos(lat[i - 1]) * math.cos(lat[i]) * math.sin((lon[i] - lon[i - 1]) / 2) ** 2
+		length += 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
+	return(length)
+#========================================================================================
+# formatDistance
+# Distance in meters as kilometers and miles, for display.
+#========================================================================================
+def formatDistance(meters):
+	return("%.2f km, %.2f miles" % (meters / 1000, meters / METERS_PER_MILE))
+#========================================================================================
+# setTrackStats
+# Work out the track's length, again if its trackpoints have changed.  With the
+# --track-stats option the length, in meters, and the number of trackpoints are written
+# in the track's extensions, and they are updated in its --stats-json entry if it has one.
+#========================================================================================
+def setTrackStats(track,args):
+	track.length = trackLength(track.lon,track.lat)
+	if args.track_stats:
+		if track.statsElements is None:
+			extensions = track.find("extensions")
+			track.statsElements = (ET.SubElement(extensions,"osmand:track_length"), ET.SubElement(extensions,"osmand:point_count"))
+		track.statsElements[0].text = "%.1f" % track.length
+		track.statsElements[1].text = str(track.countPoints())
+	if track.stats is not None:
+		track.stats["points"] = track.countPoints()
+		track.stats["length_m"] = round(track.length,1)
 #========================================================================================
 # processTrack
 #========================================================================================
-def processTrack(placemark,gpx,args):
-	global countFolderTracks
-	global countTotalTracks
+def processTrack(placemark,gpx,args,log):
 	# Get the coordinates from the KML LineString element
-	linestring = placemark.find(".//{http://www.opengis.net/kml/2.2}LineString/{http://www.opengis.net/kml/2.2}coordinates")
-	if linestring is not None:
-		countFolderTracks += 1
-		countTotalTracks += 1
+	if placemark.linestring is not None:
 		# Create the GPX Track element with the trackpoints
-		track = ET.Element("trk")
+		lon, lat, ele = parseTrackpoints(placemark.linestring)
+		countRead = len(lat)
+		countDuplicates = 0
+		if args.dedupe:
+			lon, lat, ele = dedupeTrackpoints(lon,lat,ele,args.dedupe_distance or 0.0)
+			countDuplicates = countRead - len(lat)
+		if args.simplify:
+			lon, lat, ele = simplifyTrackpoints(lon,lat,ele,args.simplify)
+		track = cTrack(lon,lat,ele,countRead,countDuplicates)
+		if args.max_track_points or args.max_points:
+			track.areas = visvalingamAreas(lon,lat)
+			if args.max_track_points:
+				keepTrackpoints(track,largestAreas(track.areas,args.max_track_points))
+			if not args.max_points:
+				track.areas = None
 		# Add the name and description from the KML Placemark element, if available
-		name = placemark.find(".//{http://www.opengis.net/kml/2.2}name")
-		if name is not None:
-			#name = html_escape(name.text.strip())
-			name = name.text.strip()
-			print("      Track:",name)
+		if placemark.name is not None:
+			#name = html_escape(placemark.name.strip())
+			name = placemark.name.strip()
+			log.printLog(LOG_DEBUG,"      Track:",name)
 			ET.SubElement(track, "name").text = name
+		if args.dedupe:
+			log.printLog(LOG_DEBUG,"         Duplicate trackpoints removed:",countDuplicates)
+		if reducesTrackpoints(args):
+			log.printLog(LOG_DEBUG,"         Trackpoints read:",countRead,"written:",track.countPoints())
 
-		description = placemark.find(".//{http://www.opengis.net/kml/2.2}description")
-		if description is not None:
-			#description = html_escape(description.text.strip())
-			description = description.text.strip()
+		if placemark.description is not None:
+			#description = html_escape(placemark.description.strip())
+			description = placemark.description.strip()
 			ET.SubElement(track, "desc").text = description
 
-		coordinates = linestring.text.strip().split()
-		trackpoints = []
-		trkseg = ET.SubElement(track, "trkseg")
-		# Iterate over the coordinates and create GPX trackpoints
-		for coordinate in coordinates:
-			longitude, latitude, altitude = coordinate.split(",")
-			trackpoint = ET.Element("trkpt", lat=latitude, lon=longitude)
-			if altitude is not None:
-				ET.SubElement(trackpoint, "ele").text = f"{float(altitude):.1f}"
-			trackpoints.append(trackpoint)
-		for trackpoint in trackpoints:
-			trkseg.append(trackpoint)
+		# The trackpoints stay in the track's arrays until the GPX file is written
+		ET.SubElement(track, "trkseg")
 
 		extensions = ET.SubElement(track,"extensions")
 
@@ -412,7 +1789,7 @@ def processTrack(placemark,gpx,args):
 		#   <styleUrl>#line-0F9D58-1000</styleUrl>
 		#Color is standard RGB color with no transparency
 		#Line width is 1000-32000.  This maps to 1.0-24.0 for OSMAnd line width
-		style_url = placemark.findtext(".//{http://www.opengis.net/kml/2.2}styleUrl")
+		style_url = placemark.styleUrl
 		if style_url:
 			style = style_url.split("-")
 			color = style[1]
@@ -424,6 +1801,7 @@ def processTrack(placemark,gpx,args):
 		else:
 			transparency = DEFAULT_TRACK_TRANSPARENCY
 		ET.SubElement(extensions, "osmand:color").text = "#" + transparency + color
+		setTrackStats(track,args)
 		
 		#Seems like the <extensions> for track width, show_arrows and split 
 		#should be associated with each track, but OSMAnd doesn't do it that way, it's file based
@@ -438,102 +1816,585 @@ def processTrack(placemark,gpx,args):
 
 		# Add the GPX Track element to the GPX file
 		gpx.append(track)
+		return(track)
+	return(None)
 #========================================================================================
-# 
+# startLayer
+# Called the first time a folder, or the <document> level when folder is None, is seen.
+# With the -l flag each folder gets its own GPX element, else everything shares gpx.
 #========================================================================================
-def processFolder(element,gpx,args):
-	global countFolderWaypoints
-	global countFolderTracks
-
-	for placemark in element.findall(".//{http://www.opengis.net/kml/2.2}Placemark"):
-		processWaypoint(placemark,gpx)
-	for placemark in element.findall(".//{http://www.opengis.net/kml/2.2}Placemark"):
-		processTrack(placemark,gpx,args)
-	print("   Waypoint count:", countFolderWaypoints)
-	print("   Track count:   ", countFolderTracks)
-	countFolderTracks = 0
-	countFolderWaypoints = 0
+def startLayer(folder,gpx,index,conversion):
+	args = conversion.args
+	conversion.printLog(LOG_INFO,"")
+	if folder is None:
+		conversion.printLog(LOG_INFO,"Processing placemarks outside of any layer")
+		return(cLayer(gpx,ROOT_LAYER_NAME))
+	conversion.countFolders += 1
+	conversion.printLog(LOG_INFO,"Processing layer#:",conversion.countFolders, "layer:",index.layerName(folder))
+	if args.layers and args.incremental:
+		outputFilename = layerFilename(folder,args,index)
+		conversion.printLog(LOG_INFO,"Writing GPX output file for layer:",index.layerName(folder),"to file:",outputFilename)
+		gpx = cGPXStream(outputFilename,conversion)
+	elif args.layers:
+		gpx = addGPXElement()
+	return(cLayer(gpx,index.layerName(folder)))
 #========================================================================================
-# Main
+# cLayerWriter
+# With the -l flag, writes each finished layer's GPX file on a pool of threads while the
+# main thread carries on converting the following layers.  Once MAX_PENDING_LAYER_WRITES
+# layers are waiting to be written the main thread waits, so memory stays capped.
+# With 0 threads each layer is written right away, before moving on.
 #========================================================================================
-def main():
-	global countFolders
-	global countFolderTracks
-	global countFolderWaypoints
-	global countTotalTracks
-	global countTotalWaypoints
-	# Parse the command line arguments
-	args = setupParseCmdLine()
-	print("")
-	print("KML to OSMAnd GPX file conversion")
-	print("  Version:" + PROGRAM_VERSION)
-	print("  Input file:        ", args.kml_file)
-	print("  Output file:       ", args.gpx_file)
-	print("  Output file path:  ", ntpath.dirname(args.gpx_file))
-	print("  Output file name:  ", ntpath.basename(args.gpx_file))
-	print("  Layer flag:        ", args.layers)
-	print("  Transparency value: 0x", args.transparency)
-	print("  Track width:       ", args.width)
-	print("  Track split:       ", args.split)
-	print("")
-	print("Starting conversion...")
-
-	# Parse the KML file
-	tree = ET.parse(args.kml_file)
-	root = tree.getroot()
-	# process the KML file a folder at a time.  If the -l flag is specified each folder's data
-	# will get written to a separate GPX file.  If the -l flag is not specifgied than all
-	# the data is saved up and written to a single file.
-
-	#Note: the iter() function returns an iterator.  There appears to be no clean way to
-	#check if the iterator is empty without using the first element.  The countFolders value
-	#is used at the end of the folder for loop to see if any folders were processed.  If not,
-	#then waypoints and tracks are processed at the root level instead of <folders> level.
+class cLayerWriter:
+	def __init__ (self,threads,conversion):
+		self.conversion = conversion
+		self.pool = None
+		if threads > 0:
+			self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+		self.pending = threading.BoundedSemaphore(MAX_PENDING_LAYER_WRITES)
+		self.futures = []
+	def write(self,layer,outputFilename):
+		if self.pool is None:
+			self.writeLayer(layer,outputFilename)
+			return
+		self.pending.acquire()
+		self.futures.append(self.pool.submit(self.writeLayer,layer,outputFilename,True))
+	def writeLayer(self,layer,outputFilename,release=False):
+		timings = self.conversion.timings
+		try:
+			with timings.phase("extensions",layer.name):
+				addFileExtensionsTags(layer.gpx,self.conversion.args)
+			with timings.phase("write",layer.name):
+				self.conversion.outputFiles.append(outputFilename)
+				writeGPXFile(layer.gpx,outputFilename,self.conversion.args)
+		finally:
+			if release:
+				self.pending.release()
+	def close(self):
+		# wait for all the layers to be written, any error writing one is raised here
+		if self.pool is not None:
+			self.pool.shutdown(wait=True)
+			for future in self.futures:
+				future.result()
+#========================================================================================
+# layerFilename
+# With the -l flag each layer is written to <gpx_file>-<layer name>.gpx, plus .gz or .zip
+# when the files are compressed.
+#========================================================================================
+def layerFilename(folder,args,index):
+	extension = ".gpx" + COMPRESS_EXTENSIONS[outputCompression(args)]
+	return(ntpath.join(ntpath.dirname(args.gpx_file),ntpath.basename(args.gpx_file) + "-" + index.fileSuffix(folder) + extension))
+#========================================================================================
+# processPlacemark
+# The placemark is classified once and handed to the waypoint and/or track conversion.
+# With --order document, or the -i flag, the track is added to the layer right away
+# instead of being held until the layer's waypoints are done.
+#========================================================================================
+def processPlacemark(placemark,layer,backend,conversion):
+	args = conversion.args
+	timings = conversion.timings
+	progress = conversion.progress
+	with timings.phase("classify",layer.name):
+		info = backend.classify(placemark)
+	if info.point is not None:
+		with timings.phase("waypoints",layer.name):
+			processWaypoint(info,layer.gpx,conversion)
+		layer.countWaypoints += 1
+		progress.waypoints += 1
+	if info.linestring is not None:
+		with timings.phase("tracks",layer.name):
+			if args.order == ORDER_DOCUMENT or args.incremental:
+				track = processTrack(info,layer.gpx,args,conversion)
+			else:
+				track = processTrack(info,layer.tracks,args,conversion)
+		layer.countTracks += 1
+		layer.countTrackpoints += track.countPoints()
+		layer.countTrackpointsRead += track.countRead
+		layer.countDuplicates += track.countDuplicates
+		layer.distance += track.length
+		if conversion.collectStats:
+			name = track.find("name")
+			track.stats = {
+				"layer":	layer.name,
+				"name":		name.text if name is not None else None,
+				"points":	track.countPoints(),
+				"length_m":	round(track.length,1),
+			}
+			layer.trackStats.append(track.stats)
+		progress.tracks += 1
+		progress.trackpoints += track.countPoints()
+	progress.update()
+#========================================================================================
+# finishLayer
+# The folder has ended.  Its tracks are added after its waypoints and the counts are
+# added to the totals.
+#========================================================================================
+def finishLayer(layer,conversion):
+	# with the -i flag this writes any tracks held back
+	with conversion.timings.phase("write",layer.name):
+		layer.gpx.extend(layer.tracks)
+	conversion.printLog(LOG_INFO,"Finished layer:", layer.name)
+	conversion.printLog(LOG_INFO,"   Waypoint count:", layer.countWaypoints)
+	conversion.printLog(LOG_INFO,"   Track count:   ", layer.countTracks)
+	conversion.countTotalWaypoints += layer.countWaypoints
+	conversion.countTotalTracks += layer.countTracks
+	conversion.countTotalTrackpoints += layer.countTrackpoints
+	conversion.countTotalTrackpointsRead += layer.countTrackpointsRead
+	conversion.countTotalDuplicates += layer.countDuplicates
+	conversion.totalDistance += layer.distance
+	conversion.trackStats.extend(layer.trackStats)
+#========================================================================================
+# cConversionCache
+# On-disk record of previous conversions, kept in CACHE_INDEX_FILE in the cache directory.
+# Each entry is keyed by a hash of the KML file's bytes plus every option that changes the
+# output, and holds the GPX files written along with their size and modification time.
+# If the same key comes up again and those files are unchanged, the conversion is skipped.
+# The least recently used entries are dropped once there are more than MAX_CACHE_ENTRIES.
+#========================================================================================
+class cConversionCache:
+	def __init__ (self,directory):
+		self.directory = directory
+		self.entries = {}
+		try:
+			with open(os.path.join(directory,CACHE_INDEX_FILE),encoding="utf-8") as f:
+				self.entries = json.load(f)
+		except (OSError, ValueError):
+			pass	# no cache yet, or it can't be read and is started over
+	def key(self,args):
+		options = {
+			"version":			PROGRAM_VERSION,
+			"gpx_file":			os.path.abspath(args.gpx_file),
+			"layers":			args.layers,
+			"transparency":		args.transparency,
+			"width":			args.width,
+			"split":			args.split,
+			"order":			ORDER_DOCUMENT if args.incremental else args.order,
+			"folders":			args.folders,
+			"compression":		outputCompression(args),
+			"compress_level":	args.compress_level,
+			"dedupe":			args.dedupe,
+			"dedupe_distance":	args.dedupe_distance,
+			"simplify":			args.simplify,
+			"max_track_points":	args.max_track_points,
+			"max_points":		args.max_points,
+			"precision":		args.precision,
+			"drop_zero_ele":	args.drop_zero_ele,
+			"track_stats":		args.track_stats,
+			"ignored_layers":	LAYERS_TO_IGNORE,
+		}
+		digest = hashlib.sha256(json.dumps(options,sort_keys=True).encode("utf-8"))
+		with open(args.kml_file,"rb") as f:
+			for block in iter(lambda: f.read(1 << 20), b""):
+				digest.update(block)
+		return(digest.hexdigest())
+	def lookup(self,key):
+		# returns the cached conversion's counts, or None if the file has to be converted
+		entry = self.entries.get(key)
+		if entry is None:
+			return(None)
+		for filename, size, modified in entry["outputs"]:
+			try:
+				status = os.stat(filename)
+			except OSError:
+				return(None)
+			if status.st_size != size or status.st_mtime_ns != modified:
+				return(None)
+		entry["used"] = time.time()
+		return(entry["counts"])
+	def outputs(self,key):
+		return([filename for filename, size, modified in self.entries[key]["outputs"]])
+	def store(self,key,counts,outputs):
+		files = []
+		for filename in outputs:
+			status = os.stat(filename)
+			files.append([os.path.abspath(filename), status.st_size, status.st_mtime_ns])
+		self.entries[key] = {"counts": list(counts), "outputs": files, "used": time.time()}
+	def save(self):
+		if len(self.entries) > MAX_CACHE_ENTRIES:
+			keep = sorted(self.entries, key=lambda key: self.entries[key]["used"])[-MAX_CACHE_ENTRIES:]
+			self.entries = {key: self.entries[key] for key in keep}
+		os.makedirs(self.directory, exist_ok=True)
+		# write a new index and then replace the old one so it's never left half written
+		filename = os.path.join(self.directory,CACHE_INDEX_FILE)
+		with open(filename + ".tmp","w",encoding="utf-8") as f:
+			json.dump(self.entries,f)
+		os.replace(filename + ".tmp",filename)
+#========================================================================================
+# convert
+# Convert the KML or KMZ file source to GPX and return a cConversionResult with the counts
+# and the GPX files written.  This is the way to use the converter from python, e.g.
+#		result = KMLtoOSMAndGPX.convert("map.kmz", {"gpx_file": "map", "layers": True})
+# options are the command line options, either the argparse.Namespace from the command
+# line or a dict keyed by the long option names with "-" changed to "_".  gpx_file is
+# required, other options left out take their command line defaults.  ValueError is raised
+# for an unknown option name, options that can't be used together and a KMZ file without
+# a KML file in it.  Nothing is kept in globals, so convert can be called any number of
+# times and from several threads at once.  The conversion cache isn't used, every call
+# converts the file.
+#========================================================================================
+def convert(source,options=None):
+	# start from the command line defaults
+	args = setupCmdLineParser().parse_args(["kml_file","gpx_file"])
+	if isinstance(options,argparse.Namespace):
+		options = vars(options)
+	else:
+		options = dict(options or {})
+		unknown = sorted(set(options) - set(vars(args)))
+		if unknown:
+			raise ValueError("unknown options: " + ", ".join(unknown))
+	if not options.get("gpx_file"):
+		raise ValueError("the gpx_file option is required")
+	for name, value in options.items():
+		setattr(args,name,value)
+	args.kml_file = source
+	args.batch = False
+	checkOptions(args)
+	conversion = cConversion(args)
+	try:
+		return(convertFile(conversion))
+	except BaseException:
+		conversion.abortStreams()
+		raise
+#========================================================================================
+# convertCached
+# Convert one KML file unless the conversion cache shows its GPX files are up to date.
+#========================================================================================
+def convertCached(args,cache):
+	# timings, memory reports and stats need the file to be converted, and stdin can't be
+	# read twice
+	if cache is None or args.timings or args.timings_json or args.memory_report or args.stats_json or STDIO_FILENAME in (args.kml_file,args.gpx_file):
+		return(convert(args.kml_file,args))
+	key = cache.key(args)
+	counts = cache.lookup(key)
+	if counts is not None:
+		log = cLog(args.log_level)
+		log.printLog(LOG_INFO,"")
+		log.printLog(LOG_INFO,"KML file and options are unchanged since it was last converted.  GPX files are up to date:")
+		for filename in cache.outputs(key):
+			log.printLog(LOG_INFO,"  ", filename)
+		log.printLog(LOG_INFO,"   Total waypoint count:", counts[0])
+		log.printLog(LOG_INFO,"   Total track count:   ", counts[1])
+		cache.save()
+		return(cConversionResult(counts[0],counts[1],counts[2],None,cache.outputs(key)))
+	result = convert(args.kml_file,args)
+	cache.store(key,(result.waypoints,result.tracks,result.trackpoints),result.outputFiles)
+	cache.save()
+	return(result)
+#========================================================================================
+# convertFile
+# Convert one KML file, conversion.args.kml_file, as specified by the options and return
+# the cConversionResult.
+#========================================================================================
+def convertFile(conversion):
+	args = conversion.args
+	timings = conversion.timings
+	printLog = conversion.printLog
+	printLog(LOG_INFO,"")
+	printLog(LOG_INFO,"KML to OSMAnd GPX file conversion")
+	printLog(LOG_INFO,"  Version:" + PROGRAM_VERSION)
+	printLog(LOG_INFO,"  Input file:        ", args.kml_file)
+	printLog(LOG_INFO,"  Output file:       ", args.gpx_file)
+	printLog(LOG_INFO,"  Output file path:  ", ntpath.dirname(args.gpx_file))
+	printLog(LOG_INFO,"  Output file name:  ", ntpath.basename(args.gpx_file))
+	printLog(LOG_INFO,"  Layer flag:        ", args.layers)
+	printLog(LOG_INFO,"  Transparency value: 0x", args.transparency)
+	printLog(LOG_INFO,"  Track width:       ", args.width)
+	printLog(LOG_INFO,"  Track split:       ", args.split)
+	printLog(LOG_INFO,"  Incremental flag:  ", args.incremental)
+	printLog(LOG_INFO,"  Output order:      ", ORDER_DOCUMENT if args.incremental else args.order)
+	printLog(LOG_INFO,"  Nested folders:    ", args.folders)
+	backend = selectBackend(args.backend,conversion)
+	printLog(LOG_INFO,"  Parser backend:    ", backend.name)
+	printLog(LOG_INFO,"")
+	printLog(LOG_INFO,"Starting conversion...")
 
-	folders = root.iter('{http://www.opengis.net/kml/2.2}Folder')
-	for folder in folders:
-		#Add the GPX element - just once if all folders are put into one GPX file,
-		#else if args.layers argument is specified add a GPX element for each folder
-		if args.layers or (countFolders == 0):
-			gpx = addGPXElement()
-		# Extract the folder name from the KML file
-		folder_name = folder.find('{http://www.opengis.net/kml/2.2}name').text
-		print("")
-		if folder_name in LAYERS_TO_IGNORE:
-			print("Skipping layer:", folder_name)
+	# Stream the KML file a placemark at a time.  If the -l flag is specified each folder's
+	# data will get written to a separate GPX file when the folder ends.  If the -l flag is
+	# not specified than all the data is saved up and written to a single file.
+	#
+	# If it was a single layer export from google maps there will be no folders, just
+	# waypoints and tracks at the <document> level.  These go into the single GPX file.
+	#
+	# With the -i flag the GPX files are cGPXStreams and each waypoint and track is written
+	# as soon as it has been converted.
+	if args.incremental:
+		gpx = cGPXStream(args.gpx_file,conversion)
+	else:
+		gpx = addGPXElement()
+	index = cFolderIndex(args.folders)
+	if args.layers and not args.incremental and not args.memory_report:
+		layerWriter = cLayerWriter(args.write_threads,conversion)
+	else:
+		layerWriter = cLayerWriter(0,conversion)
+	layers = {}
+	ignoredLayer = None
+	for event, folder, placemark in timings.iterate("parse",iterKMLPlacemarks(args.kml_file,index,backend,conversion.progress)):
+		owner = index.owner(folder)
+		if event == EVENT_FOLDER_END and owner is not folder:
+			# a nested folder ended, but its placemarks belong to the top level layer
 			continue
-		countFolders += 1
-		print("Processing layer#:",countFolders, "layer:",folder_name)
-		processFolder(folder,gpx,args)
+		folder = owner
+		if folder is not None and folder.name in LAYERS_TO_IGNORE:
+			# Placemarks in ignored layers are held aside.  They are only written if the map
+			# turns out to have no other folders, which is how a map whose only layer is
+			# still "Untitled layer" has always been converted.
+			if ignoredLayer is None:
+				ignoredLayer = cLayer(ET.Element("gpx"),IGNORED_LAYER_NAME)
+			if folder not in layers:
+				layers[folder] = ignoredLayer
+				printLog(LOG_INFO,"")
+				printLog(LOG_INFO,"Skipping layer:", folder.name)
+			if event == EVENT_PLACEMARK:
+				processPlacemark(placemark,ignoredLayer,backend,conversion)
+			else:
+				del layers[folder]
+			continue
+		layer = layers.get(folder)
+		if layer is None:
+			layer = layers[folder] = startLayer(folder,gpx,index,conversion)
+		if event == EVENT_PLACEMARK:
+			processPlacemark(placemark,layer,backend,conversion)
+			continue
+		del layers[folder]
+		finishLayer(layer,conversion)
 		#If the layers command line switch was specified then we write out each folder
 		#as a separate GPX file.
-		if args.layers:
-			outputFilename = ntpath.join(ntpath.dirname(args.gpx_file),ntpath.basename(args.gpx_file) + "-" + folder_name + ".gpx")
-			print("Writing GPX output file for layer:",folder_name,"to file:",outputFilename)
-			addFileExtensionsTags(gpx,args)
-			writeGPXFile(gpx,outputFilename)
+		if args.layers and args.incremental:
+			with timings.phase("write",layer.name):
+				layer.gpx.close(args)
+		elif args.layers:
+			if args.max_points:
+				with timings.phase("tracks",layer.name):
+					conversion.removeTrackpoints(*budgetTrackpoints(layer.gpx,args))
+			outputFilename = layerFilename(folder,args,index)
+			printLog(LOG_INFO,"Writing GPX output file for layer:",index.layerName(folder),"to file:",outputFilename)
+			layerWriter.write(layer,outputFilename)
+	layerWriter.close()
 
-	#processed all folders, but if it was a single layer export from google maps there will be 
-	#no folders, just waypoint and tracks at the <document> level. 
-	if countFolders == 0:
-		print("")
-		print("No folders found")
-		gpx = addGPXElement()
-		processFolder(root,gpx,args)
-	print("")
-	print("   Total waypoint count:", countTotalWaypoints)
-	print("   Total track count:   ", countTotalTracks)
-	print("   Total folder count:  ", countFolders)
+	#processed all folders, now finish off the placemarks at the <document> level.
+	rootLayer = layers.pop(None, None)
+	if conversion.countFolders == 0:
+		printLog(LOG_INFO,"")
+		printLog(LOG_INFO,"No folders found")
+	if conversion.countFolders == 0 and ignoredLayer is not None:
+		if rootLayer is None:
+			rootLayer = startLayer(None,gpx,index,conversion)
+		rootLayer.gpx.extend(ignoredLayer.gpx)
+		rootLayer.tracks.extend(ignoredLayer.tracks)
+		rootLayer.countWaypoints += ignoredLayer.countWaypoints
+		rootLayer.countTracks += ignoredLayer.countTracks
+		rootLayer.countTrackpoints += ignoredLayer.countTrackpoints
+		rootLayer.countTrackpointsRead += ignoredLayer.countTrackpointsRead
+		rootLayer.countDuplicates += ignoredLayer.countDuplicates
+		rootLayer.distance += ignoredLayer.distance
+		rootLayer.trackStats.extend(ignoredLayer.trackStats)
+	if rootLayer is not None:
+		finishLayer(rootLayer,conversion)
+	if args.max_points and not args.incremental and ((conversion.countFolders == 0) or (not args.layers) or (rootLayer is not None)):
+		with timings.phase("tracks"):
+			conversion.removeTrackpoints(*budgetTrackpoints(gpx,args))
+	printLog(LOG_INFO,"")
+	printLog(LOG_INFO,"   Total waypoint count:", conversion.countTotalWaypoints)
+	printLog(LOG_INFO,"   Total track count:   ", conversion.countTotalTracks)
+	printLog(LOG_INFO,"   Total track distance:", formatDistance(conversion.totalDistance))
+	printLog(LOG_INFO,"   Total folder count:  ", conversion.countFolders)
+	if reducesTrackpoints(args):
+		printLog(LOG_INFO,"   Trackpoints read:    ", conversion.countTotalTrackpointsRead)
+		if args.dedupe:
+			printLog(LOG_INFO,"   Duplicates removed:  ", conversion.countTotalDuplicates)
+		printLog(LOG_INFO,"   Trackpoints written: ", conversion.countTotalTrackpoints)
 
 	#Done processing the file and if we are not writing individual folder/layer
 	#files then write out the one and one gpx file.
 	#There's a corner case here if there are no folders and the -l (layers) flag
 	#was specified.  Could either not write out any data because there are no layers
-	#or write a single file - which is what we now do here.
-	if (countFolders == 0) or (not args.layers):
-		print("Writing single GPX output file:",args.gpx_file)
-		addFileExtensionsTags(gpx,args)
-		writeGPXFile(gpx,args.gpx_file)
+	#or write a single file - which is what we now do here.  The same is done for
+	#placemarks outside of any folder when the -l flag is specified.
+	if (conversion.countFolders == 0) or (not args.layers) or (rootLayer is not None):
+		printLog(LOG_INFO,"Writing single GPX output file:",args.gpx_file)
+		if args.incremental:
+			with timings.phase("write"):
+				gpx.close(args)
+		else:
+			with timings.phase("extensions"):
+				addFileExtensionsTags(gpx,args)
+			with timings.phase("write"):
+				conversion.outputFiles.append(args.gpx_file)
+				writeGPXFile(gpx,args.gpx_file,args)
+	timings.finish()
+	if args.memory_report:
+		timings.memory.finish()
+	if args.timings:
+		timings.display(conversion.file)
+	if args.memory_report:
+		timings.memory.display(conversion.file,conversion.countTotalWaypoints,conversion.countTotalTrackpoints)
+	if args.timings_json:
+		report = {
+			"kml_file":		args.kml_file,
+			"waypoints":	conversion.countTotalWaypoints,
+			"tracks":		conversion.countTotalTracks,
+			"trackpoints":	conversion.countTotalTrackpoints,
+			"trackpoints_read":	conversion.countTotalTrackpointsRead,
+			"duplicates_removed":	conversion.countTotalDuplicates,
+			"folders":		conversion.countFolders,
+		}
+		if args.memory_report:
+			report["memory"] = timings.memory.toDict(conversion.countTotalWaypoints,conversion.countTotalTrackpoints)
+		timings.writeJSON(args.timings_json,report)
+	result = conversion.result()
+	if args.stats_json:
+		writeStatsJSON(args.stats_json,dict(program_version=PROGRAM_VERSION,**result.stats))
+	return(result)
+#========================================================================================
+# writeStatsJSON
+# The --stats-json file: the conversion's counts and total track distance, and the layer,
+# name, trackpoint count and length of each track.  With --batch the totals for the batch
+# and each converted file's entry.
+#========================================================================================
+def writeStatsJSON(filename,stats):
+	with open(filename,"w",encoding="utf-8") as f:
+		json.dump(stats,f,indent=2)
+#========================================================================================
+# findBatchFiles
+# The KML/KMZ files in the --batch input directories or matching the input patterns.
+#========================================================================================
+def findBatchFiles(inputs):
+	kmlFiles = []
+	for pattern in inputs:
+		if os.path.isdir(pattern):
+			names = glob.glob(os.path.join(glob.escape(pattern),"*"))
+			names = [name for name in names if name.lower().endswith((".kml",".kmz"))]
+		else:
+			names = glob.glob(pattern)
+		for name in sorted(names):
+			if os.path.isfile(name) and name not in kmlFiles:
+				kmlFiles.append(name)
+	return(kmlFiles)
+#========================================================================================
+# convertBatchFile
+# Runs in a --batch worker process.  The conversion's own output is thrown away and any
+# error is returned instead of raised, so one bad file doesn't stop the rest of the batch.
+#========================================================================================
+def convertBatchFile(args):
+	try:
+		with open(os.devnull,"w") as devnull, contextlib.redirect_stdout(devnull):
+			return(convert(args.kml_file,args), None)
+	except (Exception, SystemExit) as error:
+		return(None, str(error) or type(error).__name__)
+#========================================================================================
+# convertBatch
+# Convert all the --batch input files into the output directory, args.jobs files at a time
+# in a process pool, and display the throughput.  Each output file is named after its
+# input file, or with the -l flag that name is the layer file name prefix.  An input file
+# whose output would overwrite an earlier input file's is reported as failed.
+#========================================================================================
+def convertBatch(args,cache):
+	kmlFiles = findBatchFiles(args.kml_file)
+	printLog = cLog(args.log_level).printLog
+	printLog(LOG_INFO,"")
+	printLog(LOG_INFO,"KML to OSMAnd GPX batch conversion")
+	printLog(LOG_INFO,"  Version:" + PROGRAM_VERSION)
+	printLog(LOG_INFO,"  Input files:       ", len(kmlFiles))
+	printLog(LOG_INFO,"  Output directory:  ", args.gpx_file)
+	printLog(LOG_INFO,"  Jobs:              ", args.jobs)
+	printLog(LOG_INFO,"")
+	os.makedirs(args.gpx_file, exist_ok=True)
+	countFiles = 0
+	countFailed = 0
+	countCached = 0
+	countWaypoints = 0
+	countTrackpoints = 0
+	countDistance = 0.0
+	start = time.perf_counter()
+	with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+		futures = {}
+		targets = {}
+		fileStats = {}
+		for kmlFile in kmlFiles:
+			fileArgs = argparse.Namespace(**vars(args))
+			fileArgs.batch = False
+			fileArgs.kml_file = kmlFile
+			# the workers return their stats, this process writes the one --stats-json file
+			fileArgs.stats_json = None
+			fileArgs.returnStats = args.stats_json is not None
+			fileArgs.gpx_file = os.path.join(args.gpx_file,os.path.splitext(os.path.basename(kmlFile))[0])
+			if not args.layers:
+				fileArgs.gpx_file += ".gpx" + COMPRESS_EXTENSIONS[outputCompression(fileArgs)]
+			# a.kml and a.kmz, or a.kml in two input directories, would both write out/a.gpx
+			target = os.path.normcase(fileArgs.gpx_file)
+			if target in targets:
+				countFailed += 1
+				printLog(LOG_WARNING,"FAILED:", kmlFile, "- same output file as", targets[target])
+				continue
+			targets[target] = kmlFile
+			# the cache is only used by this process, never by the workers.  Files have to be
+			# converted for their stats.
+			if cache is not None and not args.stats_json:
+				fileArgs.cacheKey = cache.key(fileArgs)
+				if cache.lookup(fileArgs.cacheKey) is not None:
+					countCached += 1
+					printLog(LOG_INFO,"Up to date:", kmlFile)
+					continue
+			futures[pool.submit(convertBatchFile,fileArgs)] = fileArgs
+		for future in concurrent.futures.as_completed(futures):
+			fileArgs = futures[future]
+			result, error = future.result()
+			if error is not None:
+				countFailed += 1
+				printLog(LOG_WARNING,"FAILED:", fileArgs.kml_file, "-", error)
+				continue
+			countFiles += 1
+			if cache is not None and not args.stats_json:
+				cache.store(fileArgs.cacheKey,(result.waypoints,result.tracks,result.trackpoints),result.outputFiles)
+			countWaypoints += result.waypoints
+			countTrackpoints += result.trackpoints
+			countDistance += result.distance
+			if result.stats is not None:
+				fileStats[fileArgs.kml_file] = result.stats
+			printLog(LOG_INFO,"Converted:", fileArgs.kml_file, "to", fileArgs.gpx_file, " waypoints:", result.waypoints, "tracks:", result.tracks, "trackpoints:", result.trackpoints)
+	elapsed = max(time.perf_counter() - start, 1e-9)
+	if cache is not None:
+		cache.save()
+	if args.stats_json:
+		writeStatsJSON(args.stats_json,{
+			"program_version":	PROGRAM_VERSION,
+			"files_converted":	countFiles,
+			"files_failed":		countFailed,
+			"waypoints":		countWaypoints,
+			"trackpoints":		countTrackpoints,
+			"distance_m":		round(countDistance,1),
+			# in input file order, not the order the workers finished in
+			"file_list":		[fileStats[kmlFile] for kmlFile in kmlFiles if kmlFile in fileStats],
+		})
+	printLog(LOG_INFO,"")
+	printLog(LOG_INFO,"   Files converted:     ", countFiles)
+	printLog(LOG_INFO,"   Files up to date:    ", countCached)
+	printLog(LOG_INFO,"   Files failed:        ", countFailed)
+	printLog(LOG_INFO,"   Total waypoint count:", countWaypoints)
+	printLog(LOG_INFO,"   Total trackpoints:   ", countTrackpoints)
+	printLog(LOG_INFO,"   Total track distance:", formatDistance(countDistance))
+	printLog(LOG_INFO,"   Elapsed seconds:     ", f"{elapsed:.2f}")
+	printLog(LOG_INFO,"   Files/second:        ", f"{countFiles / elapsed:.1f}")
+	printLog(LOG_INFO,"   Trackpoints/second:  ", f"{countTrackpoints / elapsed:.0f}")
+	return(countFailed)
+#========================================================================================
+# Main
+#========================================================================================
+def main():
+	# Parse the command line arguments
+	args = setupParseCmdLine()
+	if args.no_cache:
+		cache = None
+	else:
+		cache = cConversionCache(args.cache_dir)
+	if args.batch:
+		if convertBatch(args,cache):
+			sys.exit(1)
+	else:
+		try:
+			convertCached(args,cache)
+		except ValueError as error:
+			sys.exit(str(error))
 
 if __name__ == "__main__":
 	main()
\ No newline at end of file
@@ -0,0 +1,253 @@
+#!/usr/bin/python
+#========================================================================================
+# Benchmarks for KMLtoOSMAndGPX.py
+#
+# Generates synthetic KML files that look like google my maps exports (layers, nested
+# folders, waypoints with #icon-NNNN-COLOR styleUrls, long LineString tracks and large
+# descriptions) and times each stage of the conversion separately:
+#	parse			streaming the KML file and classifying each placemark
+#	processWaypoint	converting the waypoints
+#	processTrack	converting the tracks
+#	writeGPXFile	writing the GPX file
+# for each file size and parser backend.  The results are written to a JSON file so runs
+# can be compared to catch performance regressions.
+#
+# Examples:
+#	py KMLtoOSMAndGPXBenchmark.py
+#	py KMLtoOSMAndGPXBenchmark.py --sizes 1000,100000,1000000 --output results.json
+#	py KMLtoOSMAndGPXBenchmark.py --generate test.kml --sizes 50000
+#========================================================================================
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+import KMLtoOSMAndGPX as converter
+
+DEFAULT_SIZES = "1000,100000,1000000"
+DEFAULT_OUTPUT = "benchmark.json"
+# Tracks are split up so that none has more than this many trackpoints
+MAX_POINTS_PER_TRACK = 10000
+#========================================================================================
+#========================================================================================
+def setupParseCmdLine():
+	parser = argparse.ArgumentParser(
+	prog="KMLtoOSMAndGPXBenchmark",
+	description="Time each stage of the KMLtoOSMAndGPX conversion on generated google my maps style KML files.")
+	parser.add_argument('--sizes',
+		action='store',
+		default=DEFAULT_SIZES,
+		help='Comma separated list of total trackpoint counts to benchmark. Default: ' + DEFAULT_SIZES)
+	parser.add_argument('--output',
+		action='store',
+		default=DEFAULT_OUTPUT,
+		help='JSON file the results are written to. Default: ' + DEFAULT_OUTPUT)
+	parser.add_argument('--repeat',
+		action='store',
+		default=1,
+		type=int,
+		help='Number of times each benchmark is run.  The fastest time of each stage is reported.')
+	parser.add_argument('--folders',
+		action='store',
+		default=5,
+		type=int,
+		help='Number of top level folders/layers in the generated KML files.')
+	parser.add_argument('--depth',
+		action='store',
+		default=2,
+		type=int,
+		help='Folder nesting depth in the generated KML files.  1 is no nesting, like google my maps.')
+	parser.add_argument('--description-size',
+		action='store',
+		default=2000,
+		type=int,
+		help='Length in characters of each waypoint and track description.')
+	parser.add_argument('--backends',
+		action='store',
+		default=None,
+		help='Comma separated list of parser backends to benchmark.  Defaults to stdlib, plus lxml if it is installed.')
+	parser.add_argument('--seed',
+		action='store',
+		default=1,
+		type=int,
+		help='Random number seed, so the generated files are the same from run to run.')
+	parser.add_argument('--generate',
+		action='store',
+		default=None,
+		help='Only write a generated KML file, of the first size, to this file name.  Nothing is timed.')
+	return(parser.parse_args())
+#========================================================================================
+# generateKML
+# Write a google my maps style KML file with the given number of top level folders, each
+# nested depth folders deep, and waypoints and tracks spread across all the folders.
+# Tracks have pointsPerTrack points and wander around from a random start point.
+#========================================================================================
+def generateKML(filename,folders,depth,waypoints,tracks,pointsPerTrack,descriptionSize,seed):
+	rng = random.Random(seed)
+	iconIDs = [iconID for iconID in converter.ICON_TABLE if iconID != "unknown"] + ["9999"]
+	description = escape(("Lorem ipsum dolor sit amet, <b>consectetur</b> & adipiscing elit. " * (descriptionSize // 60 + 1))[:descriptionSize])
+	# every folder, nested ones included, gets a share of the placemarks
+	countFolders = folders * depth
+	with open(filename,"w",encoding="utf-8") as f:
+		f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+		f.write('<kml xmlns="http://www.opengis.net/kml/2.2">\n  <Document>\n    <name>Benchmark map</name>\n')
+		for iconID in iconIDs:
+			f.write('    <Style id="icon-%s-DB4436-normal"><IconStyle><scale>1</scale></IconStyle></Style>\n' % iconID)
+		folderNumber = 0
+		for top in range(folders):
+			for level in range(depth):
+				f.write('  ' * level + '    <Folder>\n')
+				f.write('  ' * level + '      <name>Layer %d-%d</name>\n' % (top + 1, level + 1))
+				for number in range(folderNumber, waypoints, countFolders):
+					writeWaypoint(f,rng,number,iconIDs,description)
+				for number in range(folderNumber, tracks, countFolders):
+					writeTrack(f,rng,number,pointsPerTrack,description)
+				folderNumber += 1
+			for level in reversed(range(depth)):
+				f.write('  ' * level + '    </Folder>\n')
+		f.write('  </Document>\n</kml>\n')
+#========================================================================================
+# writeWaypoint
+#========================================================================================
+def writeWaypoint(f,rng,number,iconIDs,description):
+	style = rng.choice(["#icon-%s-%06X", "#icon-%s-%06X-labelson", "#icon-%s-%06X-nodesc", "#icon-%s", "#icon-%s-labelson"])
+	if style.count("%") == 2:
+		styleUrl = style % (rng.choice(iconIDs), rng.randrange(0x1000000))
+	else:
+		styleUrl = style % rng.choice(iconIDs)
+	f.write('      <Placemark>\n        <name>Waypoint %d</name>\n' % number)
+	f.write('        <description>%s</description>\n' % description)
+	f.write('        <styleUrl>%s</styleUrl>\n' % styleUrl)
+	f.write('        <Point>\n          <coordinates>%.7f,%.7f,0</coordinates>\n        </Point>\n      </Placemark>\n' % (rng.uniform(-124, -114), rng.uniform(32, 42)))
+#========================================================================================
+# writeTrack
+#========================================================================================
+def writeTrack(f,rng,number,pointsPerTrack,description):
+	f.write('      <Placemark>\n        <name>Track %d</name>\n' % number)
+	f.write('        <description>%s</description>\n' % description)
+	f.write('        <styleUrl>#line-%06X-%d</styleUrl>\n' % (rng.randrange(0x1000000), rng.randrange(1000, 32000)))
+	f.write('        <LineString>\n          <tessellate>1</tessellate>\n          <coordinates>\n')
+	lon = rng.uniform(-124, -114)
+	lat = rng.uniform(32, 42)
+	points = []
+	for i in range(pointsPerTrack):
+		lon += rng.uniform(-0.0005, 0.0005)
+		lat += rng.uniform(-0.0005, 0.0005)
+		points.append('            %.7f,%.7f,0\n' % (lon, lat))
+	f.writelines(points)
+	f.write('          </coordinates>\n        </LineString>\n      </Placemark>\n')
+#========================================================================================
+# generateForSize
+# Generate the KML file for a total trackpoint count.  There is one waypoint for every 10
+# trackpoints and the tracks are split up to MAX_POINTS_PER_TRACK points each.
+#========================================================================================
+def generateForSize(filename,size,args):
+	pointsPerTrack = min(size, MAX_POINTS_PER_TRACK)
+	tracks = max(1, size // pointsPerTrack)
+	waypoints = max(10, size // 10)
+	generateKML(filename,args.folders,args.depth,waypoints,tracks,pointsPerTrack,args.description_size,args.seed)
+	return(waypoints,tracks,tracks * pointsPerTrack)
+#========================================================================================
+# timeConversion
+# Run the conversion one stage at a time and return the seconds taken by each stage.
+#========================================================================================
+def timeConversion(kmlFile,gpxFile,backend):
+	# the converter's command line defaults
+	args = converter.setupCmdLineParser().parse_args([kmlFile,gpxFile])
+	# the per placemark messages are not part of the timings
+	log = converter.cLog(converter.LOG_WARNING)
+	seconds = {}
+
+	start = time.perf_counter()
+	index = converter.cFolderIndex(converter.FOLDERS_PRESERVE)
+	placemarks = []
+	for event, folder, placemark in converter.iterKMLPlacemarks(kmlFile,index,backend):
+		if event == converter.EVENT_PLACEMARK:
+			placemarks.append(backend.classify(placemark))
+	seconds["parse"] = time.perf_counter() - start
+
+	gpx = converter.addGPXElement()
+	start = time.perf_counter()
+	for placemark in placemarks:
+		if placemark.point is not None:
+			converter.processWaypoint(placemark,gpx,log)
+	seconds["processWaypoint"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	for placemark in placemarks:
+		if placemark.linestring is not None:
+			converter.processTrack(placemark,gpx,args,log)
+	seconds["processTrack"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	converter.addFileExtensionsTags(gpx,args)
+	converter.writeGPXFile(gpx,gpxFile)
+	seconds["writeGPXFile"] = time.perf_counter() - start
+	return(seconds)
+#========================================================================================
+# Main
+#========================================================================================
+def main():
+	args = setupParseCmdLine()
+	sizes = [int(size) for size in args.sizes.split(",")]
+	if args.generate:
+		waypoints, tracks, trackpoints = generateForSize(args.generate,sizes[0],args)
+		print("Wrote", args.generate, " waypoints:", waypoints, "tracks:", tracks, "trackpoints:", trackpoints)
+		return
+	if args.backends:
+		backends = args.backends.split(",")
+	else:
+		backends = [converter.BACKEND_STDLIB]
+		if converter.lxmlET is not None:
+			backends.append(converter.BACKEND_LXML)
+
+	results = []
+	with tempfile.TemporaryDirectory() as directory:
+		for size in sizes:
+			kmlFile = os.path.join(directory,"benchmark-%d.kml" % size)
+			gpxFile = os.path.join(directory,"benchmark-%d.gpx" % size)
+			waypoints, tracks, trackpoints = generateForSize(kmlFile,size,args)
+			for backendName in backends:
+				backend = converter.selectBackend(backendName,converter.cLog(converter.LOG_INFO))
+				best = None
+				for run in range(args.repeat):
+					# the conversion's per placemark output is not part of the timings
+					with open(os.devnull,"w") as devnull, contextlib.redirect_stdout(devnull):
+						seconds = timeConversion(kmlFile,gpxFile,backend)
+					if best is None:
+						best = seconds
+					else:
+						best = {stage: min(best[stage], seconds[stage]) for stage in best}
+				best["total"] = sum(best.values())
+				results.append({
+					"size":			size,
+					"backend":		backend.name,
+					"waypoints":	waypoints,
+					"tracks":		tracks,
+					"trackpoints":	trackpoints,
+					"kml_bytes":	os.path.getsize(kmlFile),
+					"gpx_bytes":	os.path.getsize(gpxFile),
+					"seconds":		best,
+				})
+				print("size:", size, "backend:", backend.name, " ".join("%s: %.3fs" % (stage, best[stage]) for stage in best))
+			os.remove(kmlFile)
+			os.remove(gpxFile)
+
+	with open(args.output,"w",encoding="utf-8") as f:
+		json.dump({
+			"program_version":	converter.PROGRAM_VERSION,
+			"python":			platform.python_version(),
+			"platform":			platform.platform(),
+			"numpy":			converter.numpy is not None,
+			"date":				time.strftime("%Y-%m-%dT%H:%M:%S"),
+			"results":			results,
+		}, f, indent=2)
+	print("Results written to", args.output)
+
+if __name__ == "__main__":
+	main()